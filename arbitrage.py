@@ -1,8 +1,22 @@
 #!/usr/bin/env python3
 
 import serial
-import io
 import threading
+import collections
+import bisect
+import enum
+import inspect
+import numbers
+import contextlib
+import array
+import sys
+import time
+import os
+import glob
+import json
+import string
+from concurrent import futures
+from concurrent.futures import Future
 
 class RangeException(BaseException):
     """Parameter out of range"""
@@ -12,123 +26,1324 @@ class DeviceException(BaseException):
     """Unsupported device"""
     pass
 
+class CommandError(BaseException):
+    """The device reported errors at a sync() fence.
+    'errors' holds the (code, text) pairs drained from its error queue (code None if no reply came),
+    'commands' the commands sent since the previous fence, which caused them"""
+    def __init__(self, errors, commands):
+        self.errors=errors
+        self.commands=commands
+        super().__init__(', '.join(str(code)+' "'+text+'"' for code, text in errors)+
+                         ' in window of '+str(len(commands))+' commands: '+'; '.join(commands))
+
+##############################
+#       COMMAND TABLE        #
+##############################
+# The command methods of AFGbase and AFG2100 are generated from 'basecommands' and
+# 'modulationcommands' (see below the classes). Arguments are validated here, before anything is sent.
+
+class Param():
+    """Argument of a table command, sent as str(value)"""
+    def __init__(self, name, default=None):
+        self.name=name
+        self.default=default
+    
+    def encode(self, gen, value, values):
+        return str(value)
+
+class Chan(Param):
+    """Output channel, checked against the model's 'channels'"""
+    def __init__(self, name='chan', default=1):
+        super().__init__(name, default)
+    
+    def encode(self, gen, value, values):
+        if value not in gen.channels:
+            raise RangeException(self.name+'='+repr(value)+' not in '+repr(gen.channels))
+        return str(value)
+
+class Number(Param):
+    """Number within 'limits', which is a (min, max) tuple, None, or a function(gen, values) returning one.
+    With 'minmax' the strings 'MIN' and 'MAX' are accepted too"""
+    def __init__(self, name, default=None, limits=None, minmax=True):
+        super().__init__(name, default)
+        self.limits=limits
+        self.minmax=minmax
+    
+    def encode(self, gen, value, values):
+        if isinstance(value, str):
+            if self.minmax and value.upper() in ('MIN','MAX','MINIMUM','MAXIMUM'):
+                return value.upper()[:3]
+            try:
+                number=float(value)
+            except ValueError:
+                raise RangeException(self.name+'='+repr(value)+' is not a number')
+        elif isinstance(value, numbers.Real) and not isinstance(value, bool):
+            number=value
+        else:
+            raise RangeException(self.name+'='+repr(value)+' is not a number')
+        limits=self.limits(gen, values) if callable(self.limits) else self.limits
+        if limits is not None and not limits[0] <= number <= limits[1]:
+            raise RangeException(self.name+'='+repr(value)+' outside '+repr(limits))
+        return str(value)
+
+class Int(Number):
+    """Integer within 'limits'"""
+    def __init__(self, name, default=None, limits=None):
+        super().__init__(name, default, limits, minmax=False)
+    
+    def encode(self, gen, value, values):
+        if not isinstance(value, numbers.Integral) or isinstance(value, bool):
+            raise RangeException(self.name+'='+repr(value)+' is not an integer')
+        return super().encode(gen, value, values)
+
+class Enum(Param):
+    """One of 'allowed' (case insensitive)"""
+    def __init__(self, name, default, allowed):
+        super().__init__(name, default)
+        self.allowed=frozenset(allowed)
+    
+    def encode(self, gen, value, values):
+        if not isinstance(value, str) or value.upper() not in self.allowed:
+            raise RangeException(self.name+'='+repr(value)+' not in '+repr(sorted(self.allowed)))
+        return value.upper()
+
+class Switch(Param):
+    """ON if true, OFF otherwise"""
+    def encode(self, gen, value, values):
+        return "ON" if value else "OFF"
+
+class Command():
+    """Table entry: method 'name' sends SCPI 'template' filled with its encoded 'params'.
+    The constant parts of the template are encoded to bytes once, only the fields are encoded per call.
+    'reply' converts the reply of a query, e.g. to_float"""
+    def __init__(self, name, template, params, doc, reply=None):
+        self.name=name
+        self.template=template
+        self.params=params
+        self.names=[p.name for p in params]
+        self.defaults={p.name: p.default for p in params}
+        self.doc=doc
+        self.reply=reply
+        # template 'A{x}B{y}' -> literals [b'A', b'B', b'\r'], fields ['x', 'y']
+        self.literals=[]
+        self.fields=[]
+        for literal, field, spec, conversion in string.Formatter().parse(template):
+            self.literals.append(literal.encode('ascii'))
+            if field is not None:
+                self.fields.append(field)
+        if len(self.literals) == len(self.fields):
+            self.literals.append(b'')
+        self.literals[-1]+=b'\r'
+    
+    def encode(self, gen, args, kwargs):
+        """Returns the command string and its line bytes for call arguments 'args' and 'kwargs',
+        raises RangeException if invalid"""
+        if len(args) > len(self.params):
+            raise TypeError(self.name+'() takes '+str(len(self.params))+' arguments')
+        values=dict(self.defaults)
+        values.update(zip(self.names, args))
+        for key in kwargs:
+            if key not in values:
+                raise TypeError(self.name+"() got an unexpected keyword argument '"+key+"'")
+        values.update(kwargs)
+        encoded={p.name: p.encode(gen, values[p.name], values) for p in self.params}
+        data=bytearray(self.literals[0])
+        for field, literal in zip(self.fields, self.literals[1:]):
+            data+=encoded[field].encode('ascii')
+            data+=literal
+        return data[:-1].decode('ascii'), bytes(data)
+    
+    def method(self):
+        cmd=self
+        def method(self, *args, **kwargs):
+            return self.typed(self.msg(*cmd.encode(self, args, kwargs)), cmd.reply)
+        method.__name__=self.name
+        method.__qualname__=self.name
+        method.__doc__=self.doc
+        method.__signature__=inspect.Signature(
+            [inspect.Parameter('self', inspect.Parameter.POSITIONAL_OR_KEYWORD)]+
+            [inspect.Parameter(p.name, inspect.Parameter.POSITIONAL_OR_KEYWORD, default=p.default) for p in self.params])
+        return method
+
+def install(cls, table):
+    """Adds a method for every Command in 'table' to class 'cls'"""
+    for cmd in table:
+        setattr(cls, cmd.name, cmd.method())
+
+def frequency_limits(gen, values):
+    return gen.frequency_limits(values.get('func'), values.get('chan', 1))
+
+def number(value):
+    """'value' as float, None if it is not a number (e.g. 'MIN' or 'MAX')"""
+    if isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+# apply_func sets amplitude (taken as Vpp) and offset together, each limits the other
+def amplitude_limits(gen, values):
+    if 'off' in values:
+        return gen.amplitude_limits('VPP', values.get('chan', 1), number(values['off']) or 0.0)
+    return gen.amplitude_limits(chan=values.get('chan', 1))
+
+def offset_limits(gen, values):
+    if 'amp' in values:
+        return gen.offset_limits(number(values['amp']) or 0.0, values.get('chan', 1))
+    return gen.offset_limits(chan=values.get('chan', 1))
+
+# Reply types
+###################
+class Function(str, enum.Enum):
+    """Output and modulation functions, equal to their SCPI short form"""
+    SIN='SIN'
+    SQUARE='SQU'
+    RAMP='RAMP'
+    NOISE='NOIS'
+    USER='USER'
+
+class VoltUnit(str, enum.Enum):
+    VPP='VPP'
+    VRMS='VRMS'
+    DBM='DBM'
+
+class Load(str, enum.Enum):
+    """Output load, DEF is 50 ohm, INF high impedance"""
+    DEF='DEF'
+    INF='INF'
+
+Apply=collections.namedtuple('Apply', 'func freq amp offset')
+
+def reply_text(reply):
+    return reply.strip().strip('"').upper()
+
+def to_float(reply):
+    return float(reply)
+
+def to_bool(reply):
+    """'1'/'ON' -> True, '0'/'OFF' -> False"""
+    value=reply_text(reply)
+    if value in ('ON','OFF'):
+        return value == 'ON'
+    return float(value) != 0
+
+def to_enum(cls):
+    """Returns a converter to the member of enum 'cls' the reply starts with (replies may use long forms)"""
+    def convert(reply):
+        value=reply_text(reply)
+        for member in cls:
+            if value.startswith(member.value):
+                return member
+        raise ValueError(repr(reply)+' is no '+cls.__name__)
+    return convert
+
+def to_apply(reply):
+    """'"SIN +1.0E+03,+1.0E-01,+0.0E+00"' -> Apply(Function.SIN, 1000.0, 0.1, 0.0), values the device
+    does not report as number are None"""
+    func, _, values = reply_text(reply).partition(' ')
+    fields=[]
+    for value in (values.split(',')+['', '', ''])[:3]:
+        try:
+            fields.append(float(value))
+        except ValueError:
+            fields.append(None)
+    return Apply(to_enum(Function)(func), *fields)
+
+def is_query(msg):
+    """Returns True if SCPI command 'msg' expects a reply (ends in '?')"""
+    return msg.rstrip().endswith('?')
+
+class DacBlock(bytes):
+    """16 bit DAC words already encoded in 'byteorder', e.g. taken from a cache"""
+    def __new__(cls, words, byteorder='big'):
+        block=super().__new__(cls, words)
+        block.byteorder=byteorder
+        return block
+
+def dac_block(block, dacrange=(-511,511), byteorder='big'):
+    """Returns integer samples 'block' as 16 bit DAC words in 'byteorder' ('big' or 'little').
+    'block' can be a NumPy integer array, any buffer or a sequence of ints.
+    A DacBlock is passed through unchecked.
+    Raises RangeException if a sample lies outside 'dacrange'"""
+    if isinstance(block, DacBlock):
+        if block.byteorder != byteorder:
+            raise ValueError('DacBlock is '+block.byteorder+' endian, device expects '+byteorder)
+        return memoryview(block)
+    if hasattr(block, 'astype'):
+        if block.dtype.kind not in 'iu':
+            raise TypeError('DAC samples must be integers, not '+str(block.dtype))
+        if block.size and (block.min() < dacrange[0] or block.max() > dacrange[1]):
+            raise RangeException
+        return memoryview(block.astype(('>' if byteorder=='big' else '<')+'i2').tobytes())
+    try:
+        values=memoryview(block).tolist()
+    except TypeError:
+        values=block
+    words=array.array('h', values)
+    if words and (min(words) < dacrange[0] or max(words) > dacrange[1]):
+        raise RangeException
+    if sys.byteorder != byteorder:
+        words.byteswap()
+    return memoryview(words).cast('B')
+
+def block_header(nbytes):
+    """Returns the IEEE 488.2 definite-length block header '#<n><len>' for 'nbytes' of data"""
+    length=str(nbytes)
+    return ('#'+str(len(length))+length).encode('ascii')
+
+class ShadowState():
+    """Last value set or read for each cached parameter, keyed by SCPI header (e.g. 'SOURCE1:FREQ')"""
+    params=('FUNC','FREQ','AMPL','DCO','SQUARE:DCYCLE','RAMP:SYMM','VOLT:UNIT','OUTP','OUTP:LOAD')
+    # parameters the device may coerce or rescale when another one changes
+    depends={'FUNC':('FREQ','AMPL','DCO'), 'VOLT:UNIT':('AMPL','DCO'), 'OUTP:LOAD':('AMPL','DCO')}
+    
+    def __init__(self):
+        self.values=dict()
+        self.served=0
+        self.skipped=0
+    
+    def parse(self, msg):
+        """Splits 'msg' into SCPI header, parameter name without channel, and value"""
+        header, _, value = msg.strip().partition(' ')
+        header=header.upper().rstrip('?')
+        if header.startswith('SOURCE') and ':' in header:
+            param=header.split(':',1)[1]
+        else:
+            param=header
+        return header, param, value.strip()
+    
+    def normalize(self, value):
+        value=value.strip().strip('"').upper()
+        if value in ('ON','OFF'):
+            return 1.0 if value == 'ON' else 0.0
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    
+    def get(self, msg):
+        """Returns the cached value for query 'msg', None if unknown"""
+        header, param, value = self.parse(msg)
+        entry=self.values.get(header)
+        if entry is None:
+            return None
+        self.served+=1
+        return entry[0]
+    
+    def set(self, msg):
+        """Records set command 'msg'. Returns False if it would not change the cached state"""
+        header, param, value = self.parse(msg)
+        if header.startswith(('*RST','*RCL')) or 'APPL' in header:
+            self.clear()
+            return True
+        if param not in self.params:
+            return True
+        norm=self.normalize(value)
+        entry=self.values.get(header)
+        if entry is not None and entry[1] == norm:
+            self.skipped+=1
+            return False
+        for dep in self.depends.get(param, ()):
+            self.invalidate(dep)
+        if norm in ('MIN','MAX'):
+            self.values.pop(header, None)
+        else:
+            self.values[header]=(value, norm)
+        return True
+    
+    def read(self, msg, reply):
+        """Records 'reply' to query 'msg'"""
+        header, param, value = self.parse(msg)
+        if param in self.params and reply is not None:
+            self.values[header]=(reply, self.normalize(reply))
+    
+    def invalidate(self, param):
+        """Forgets 'param' on all channels"""
+        for header in list(self.values):
+            if header == param or header.endswith(':'+param):
+                del self.values[header]
+    
+    def clear(self):
+        self.values.clear()
+
+class Coalescer():
+    """Set commands waiting to be written, only the latest per SCPI header (e.g. 'SOURCE1:FREQ'),
+    in the order they were last set. Written at most once per 'interval' seconds"""
+    def __init__(self, interval):
+        self.interval=interval
+        self.pending=collections.OrderedDict()
+        self.lock=threading.RLock()
+        self.last=float('-inf')
+        self.scheduled=False
+        self.received=0
+        self.written=0
+        self.flushes=0
+    
+    def key(self, msg):
+        return msg.lstrip(':').partition(' ')[0].upper()
+    
+    def coalescible(self, msg):
+        """Returns True for set commands that only change one parameter"""
+        header=self.key(msg)
+        return not (header.startswith(('*','DATA')) or 'APPL' in header or ';' in msg)
+    
+    def add(self, msg):
+        key=self.key(msg)
+        self.pending[key]=msg
+        self.pending.move_to_end(key)
+        self.received+=1
+    
+    def take(self):
+        """Returns the pending commands and forgets them"""
+        cmds=list(self.pending.values())
+        self.pending.clear()
+        self.written+=len(cmds)
+        self.flushes+=1
+        self.last=time.monotonic()
+        return cmds
+
+def open_transport(dev, timeout=None):
+    """Returns an open connection with the serial.Serial interface (read, write, in_waiting, timeout,
+    flush, close and, where possible, cancel_read and fileno) for 'dev', which can be:
+    -an already open connection, which is used as it is
+    -'sim://<model>?baudrate=..&latency=..', an in-process simulated instrument (see simulator.py)
+    -'unix://<path>', an instrument shared by a server on a Unix socket (see server.py)
+    -'replay://<path>?speed=..', a recorded session played back (see replay.py)
+    -'socket://<host>:<port>', raw TCP to a LAN-attached SCPI bridge, or another pySerial URL (e.g. 'loop://')
+    -a serial port name, opened at 9600 8N1"""
+    if not isinstance(dev, str):
+        dev.timeout=timeout
+        return dev
+    if dev.startswith('sim://'):
+        import simulator
+        return simulator.open_url(dev, timeout)
+    if dev.startswith('unix://'):
+        import server
+        return server.open_url(dev, timeout)
+    if dev.startswith('replay://'):
+        import replay
+        return replay.open_url(dev, timeout)
+    if '://' in dev:
+        return serial.serial_for_url(dev, baudrate=9600, timeout=timeout)
+    return serial.Serial(port=dev,
+                         baudrate=9600,
+                         bytesize=serial.EIGHTBITS,
+                         parity=serial.PARITY_NONE,
+                         stopbits=serial.STOPBITS_ONE,
+                         timeout=timeout)
+
+def command_key(msg):
+    """Returns the SCPI header command 'msg' is counted under in CommandStats (of the first one of ';'-joined commands)"""
+    # a leading ':' (as batch_lines() adds) only resets the header path
+    return msg.split(';', 1)[0].strip().lstrip(':').split(' ', 1)[0].upper()
+
+class ReplyTimeouts():
+    """Reply timeouts per command (see command_key), learned from the observed reply times like TCP does
+    (smoothed time plus four times its deviation) and kept within 'minimum' and 'maximum'.
+    After a timeout the timeout itself is doubled until the command is answered again.
+    'overrides' fixes the time for a command. For set commands it is how long the device may be busy
+    with it, which is added to the timeout of the replies that follow"""
+    overrides={'*RST': 2.0, '*RCL': 2.0, '*SAV': 2.0, 'DATA:DAC': 2.0, '*OPC?': 10.0}
+    
+    def __init__(self, minimum=0.05, maximum=10.0):
+        self.minimum=minimum
+        self.maximum=maximum
+        self.overrides=dict(ReplyTimeouts.overrides)
+        self.estimates=dict()
+        self.backoffs=dict()
+        self.busy=0.0
+    
+    def keys(self, msg):
+        """Returns the keys of the queries in 'msg', which may be ';'-joined"""
+        return [command_key(part) for part in msg.split(';') if is_query(part)] or [command_key(msg)]
+    
+    def single(self, key, default):
+        if key in self.overrides:
+            return self.overrides[key]
+        if key in self.backoffs:
+            return self.backoffs[key]
+        if key in self.estimates:
+            srtt, rttvar = self.estimates[key]
+            return min(max(srtt+4*rttvar, self.minimum), self.maximum)
+        return default
+    
+    def timeout(self, msg, default):
+        """Returns the seconds to wait for the reply to 'msg', 'default' for commands nothing was learned about yet.
+        A ';'-joined line gets the longest timeout of its queries plus the smoothed reply times of the others,
+        so the *OPC? of a fence keeps its override"""
+        keys=self.keys(msg)
+        seconds=[self.single(key, default) for key in keys]
+        longest=max(range(len(keys)), key=seconds.__getitem__)
+        others=sum(self.estimates[key][0] for i, key in enumerate(keys) if i != longest and key in self.estimates)
+        return seconds[longest]+others+max(0.0, self.busy-time.monotonic())
+    
+    def learn(self, msg, seconds):
+        """Adds the reply time 'seconds' of 'msg' to the estimate, shared evenly by the queries of a ';'-joined line"""
+        keys=self.keys(msg)
+        seconds/=len(keys)
+        for key in keys:
+            self.backoffs.pop(key, None)
+            estimate=self.estimates.get(key)
+            if estimate is None:
+                self.estimates[key]=(seconds, seconds/2)
+            else:
+                srtt, rttvar = estimate
+                self.estimates[key]=(0.875*srtt+0.125*seconds, 0.75*rttvar+0.25*abs(srtt-seconds))
+    
+    def backoff(self, msg, default, observed=0.0):
+        """Doubles the timeouts of the queries in 'msg' after it timed out, until they are answered again.
+        'observed' is a round trip time measured meanwhile (e.g. the resync handshake), the timeout is at least that"""
+        for key in self.keys(msg):
+            if key not in self.overrides:
+                self.backoffs[key]=min(max(2*self.single(key, default), observed), self.maximum)
+    
+    def sent(self, msg):
+        """Notes that 'msg' was written, set commands with an override keep the device busy"""
+        for part in msg.split(';'):
+            seconds=self.overrides.get(command_key(part))
+            if seconds is not None and not is_query(part):
+                self.busy=max(self.busy, time.monotonic()+seconds)
+
+class CommandStats():
+    """Per command counters, latency histograms and byte counts"""
+    # upper bounds of the latency histogram buckets in seconds
+    buckets=(1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        with self.lock:
+            self.commands=dict()
+            self.waiting=0.0
+    
+    def record(self, key, seconds, written, read=0, timeout=False, noreply=False):
+        """Records one command 'key' that took 'seconds' and moved 'written'/'read' bytes"""
+        with self.lock:
+            entry=self.commands.get(key)
+            if entry is None:
+                entry=self.commands[key]={'count': 0, 'seconds': 0.0, 'max': 0.0, 'written': 0, 'read': 0,
+                                          'timeouts': 0, 'noreply': 0, 'histogram': [0]*(len(self.buckets)+1)}
+            entry['count']+=1
+            entry['seconds']+=seconds
+            entry['max']=max(entry['max'], seconds)
+            entry['written']+=written
+            entry['read']+=read
+            entry['timeouts']+=timeout
+            entry['noreply']+=noreply
+            entry['histogram'][bisect.bisect_left(self.buckets, seconds)]+=1
+    
+    def record_line(self, msg, seconds, written, reply=None, timeout=False, noreply=False):
+        """Records line 'msg' that moved 'written' bytes and got 'reply'. The commands of a ';'-joined line
+        are recorded each under its own header, with an even share of the latency, its own bytes
+        and for queries the bytes of its reply field"""
+        parts=msg.split(';')
+        if len(parts) == 1:
+            self.record(command_key(msg), seconds, written, len(reply)+1 if reply is not None else 0, timeout, noreply)
+            return
+        nqueries=sum(map(is_query, parts))
+        fields=reply.split(';', nqueries-1) if reply is not None and nqueries else []
+        n=0
+        for part in parts:
+            query=is_query(part)
+            read=len(fields[n])+1 if query and n < len(fields) else 0
+            n+=query
+            self.record(command_key(part), seconds/len(parts), len(part)+1, read, timeout and query, noreply and query)
+    
+    def wait(self, seconds):
+        """Records 'seconds' a caller spent blocked waiting for a reply"""
+        with self.lock:
+            self.waiting+=seconds
+    
+    def snapshot(self):
+        """Returns a copy of all counters: {'commands': {header: {...}}, 'waiting': seconds, 'buckets': bounds}.
+        histogram[i] counts commands with latency <= buckets[i], the last entry those above"""
+        with self.lock:
+            return {'commands': {k: dict(v, histogram=list(v['histogram'])) for k, v in self.commands.items()},
+                    'waiting': self.waiting,
+                    'buckets': self.buckets}
+    
+    def prometheus(self, prefix='arbitrage', labels=None):
+        """Returns the counters in Prometheus text exposition format.
+        'labels' (e.g. {'device': 'afg1'}) are added to every sample"""
+        snap=self.snapshot()
+        extra=''.join(','+k+'="'+str(v)+'"' for k, v in (labels or dict()).items())
+        base='{'+extra[1:]+'}' if extra else ''
+        out=[]
+        def metric(name, kind, helptext):
+            out.append('# HELP '+prefix+'_'+name+' '+helptext)
+            out.append('# TYPE '+prefix+'_'+name+' '+kind)
+        counters=(('commands_total', 'count', 'Commands sent'),
+                  ('bytes_written_total', 'written', 'Bytes written'),
+                  ('bytes_read_total', 'read', 'Reply bytes read'),
+                  ('timeouts_total', 'timeouts', 'Queries without reply within the timeout'),
+                  ('no_reply_total', 'noreply', 'Queries that ended without reply'))
+        for name, field, helptext in counters:
+            metric(name, 'counter', helptext)
+            for key, entry in sorted(snap['commands'].items()):
+                out.append(prefix+'_'+name+'{command="'+key+'"'+extra+'} '+str(entry[field]))
+        metric('command_latency_seconds', 'histogram', 'Command latency')
+        for key, entry in sorted(snap['commands'].items()):
+            labels='command="'+key+'"'+extra
+            total=0
+            for bound, n in zip(self.buckets, entry['histogram']):
+                total+=n
+                out.append(prefix+'_command_latency_seconds_bucket{'+labels+',le="'+repr(bound)+'"} '+str(total))
+            out.append(prefix+'_command_latency_seconds_bucket{'+labels+',le="+Inf"} '+str(entry['count']))
+            out.append(prefix+'_command_latency_seconds_sum{'+labels+'} '+repr(entry['seconds']))
+            out.append(prefix+'_command_latency_seconds_count{'+labels+'} '+str(entry['count']))
+        metric('wait_seconds_total', 'counter', 'Time callers spent blocked waiting for replies')
+        out.append(prefix+'_wait_seconds_total'+base+' '+repr(snap['waiting']))
+        return '\n'.join(out)+'\n'
+
+def read_reply(ser, terminators=b'\r\n'):
+    """Reads one reply line from serial port 'ser'.
+    Returns as soon as one of 'terminators' arrives instead of waiting for the port timeout.
+    Empty lines (e.g. the '\n' of a '\r\n' pair) are skipped.
+    Returns None if the port timeout runs out before a line is complete"""
+    line=bytearray()
+    while True:
+        c=ser.read(1)
+        if not c:
+            return None
+        if c in terminators:
+            if line:
+                return line.decode('ascii', errors='replace').strip()
+        else:
+            line+=c
+
+class JSONStore():
+    """Dict 'entries' kept as JSON in 'path' (default $XDG_CACHE_HOME/arbitrage/<name>).
+    Change 'entries' only while holding 'lock', save() writes it atomically"""
+    def __init__(self, name, path=None):
+        if path is None:
+            cachedir=os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+            path=os.path.join(cachedir, 'arbitrage', name)
+        self.path=path
+        self.lock=threading.RLock()
+        try:
+            with open(path) as f:
+                self.entries=json.load(f)
+        except (OSError, ValueError):
+            self.entries=dict()
+    
+    def save(self):
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp=self.path+'.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp, self.path)
+
+class IdentityCache(JSONStore):
+    """Persistent *idn? replies of USB instruments, keyed by port and USB serial number.
+    Stored as JSON in 'path' (default $XDG_CACHE_HOME/arbitrage/identity.json)"""
+    def __init__(self, path=None):
+        super().__init__('identity.json', path)
+    
+    def key(self, port, serialnumber):
+        return port+'|'+serialnumber
+    
+    def get(self, port, serialnumber):
+        """Returns the cached identity, None if unknown or the port has no USB serial number"""
+        if not serialnumber:
+            return None
+        return self.entries.get(self.key(port, serialnumber))
+    
+    def set(self, port, serialnumber, info):
+        if serialnumber:
+            with self.lock:
+                self.entries[self.key(port, serialnumber)]=info
+    
+    def forget(self, port, serialnumber):
+        if serialnumber:
+            with self.lock:
+                self.entries.pop(self.key(port, serialnumber), None)
+
+def candidate_ports(patterns=('/dev/ttyACM*','/dev/ttyUSB*')):
+    """Returns (port, USB serial number or None) for all ports matching 'patterns'"""
+    import serial.tools.list_ports
+    serialnumbers={p.device: p.serial_number for p in serial.tools.list_ports.comports()}
+    ports=sorted(set(p for pattern in patterns for p in glob.glob(pattern)))
+    return [(p, serialnumbers.get(p)) for p in ports]
+
+def discover(ports=None, identitycache=True):
+    """Scans 'ports' (default: candidate_ports()) in parallel and opens every supported instrument.
+    'ports' can be port names or (port, USB serial number) pairs.
+    Instruments found in the identity cache are opened without asking for *idn?.
+    'identitycache' can be True (default location), False or an IdentityCache.
+    Returns a dict port -> Arbitrage, ports without a supported instrument are left out"""
+    if ports is None:
+        ports=candidate_ports()
+    ports=[p if isinstance(p, tuple) else (p, None) for p in ports]
+    if identitycache is True:
+        identitycache=IdentityCache()
+    
+    def probe(port, serialnumber):
+        info=identitycache.get(port, serialnumber) if identitycache else None
+        try:
+            arb=Arbitrage(port, info=info)
+        except DeviceException:
+            if info is None:
+                return None
+            # stale cache entry, ask the device
+            identitycache.forget(port, serialnumber)
+            try:
+                arb=Arbitrage(port)
+            except (DeviceException, serial.SerialException, OSError):
+                return None
+        except (serial.SerialException, OSError):
+            return None
+        if identitycache:
+            identitycache.set(port, serialnumber, arb.info)
+        return arb
+    
+    found=dict()
+    if ports:
+        with futures.ThreadPoolExecutor(max_workers=len(ports)) as pool:
+            for (port, serialnumber), arb in zip(ports, pool.map(lambda p: probe(*p), ports)):
+                if arb is not None:
+                    found[port]=arb
+    if identitycache:
+        try:
+            identitycache.save()
+        except OSError:
+            pass
+    return found
+
 class Arbitrage():
-    def __init__(self,dev):
+    def __init__(self, dev, info=None):
+        """Identifies the function generator at 'dev' and opens it as matching model class in 'self.device'.
+        'dev' is a port name, URL or open connection, see open_transport.
+        The identification connection is handed over to the model class.
+        'info' is a known *idn? reply (e.g. from an IdentityCache), then the device is not asked"""
         self.readresponse=True
         self.opencon(dev)
-        self.info = self.msg('*idn?')
+        self.info = info if info is not None else self.msg('*idn?')
+        for model, modelcls in models.items():
+            if self.info is not None and model in self.info:
+                self.device=modelcls(self.ser)
+                return
         self.closecon()
-        if "AFG-2005" in self.info:
-            self.device=AFG2005(dev)
-        elif "AFG-2105" in self.info:
-            self.device=AFG2105(dev)
-        elif "AFG-2012" in self.info:
-            self.device=AFG2012(dev)
-        elif "AFG-2112" in self.info:
-            self.device=AFG2112(dev)
-        elif "AFG-2025" in self.info:
-            self.device=AFG2025(dev)
-        elif "AFG-2125" in self.info:
-            self.device=AFG2125(dev)
-        else:
-            raise DeviceException
+        raise DeviceException
             
     def opencon(self,dev):
-        self.ser = serial.Serial(port=dev,
-                                 baudrate=9600,
-                                 bytesize=serial.EIGHTBITS,
-                                 parity=serial.PARITY_NONE,
-                                 stopbits=serial.STOPBITS_ONE,
-                                 timeout=0.1)
-        
-        self.buf = io.TextIOWrapper(io.BufferedRWPair(self.ser, self.ser, 33554432), newline='\r', line_buffering = True)
+        self.ser = open_transport(dev, timeout=0.1)
     
     def closecon(self):
         self.ser.close()
 
     def msg(self, msg):
-        self.buf.write(msg+'\n')
-        if self.readresponse:
-            lines=self.buf.readlines()
-            if len(lines)>0:
-                return lines[0].strip()
-            else:
-                return lines
+        """Sends 'msg' to the device.
+        Set commands return right after the write, queries return their reply line
+        (None if no reply arrives within the port timeout)"""
+        self.ser.write((msg+'\r').encode('ascii'))
+        if self.readresponse and is_query(msg):
+            return read_reply(self.ser)
         else:
-            return ['']
+            return None
 
 class AFGbase():
     def __init__(self,dev):
         self.frequencyrange=dict()
         self.frequencyrange["Triangle"]=(0.1,1*10**6)
         self.frequencyrange["Ramp"]=(0.1,1*10**6)
-        self.opencon(dev)
+        # amplitude per unit and offset into 50 ohm, twice the voltages into high impedance.
+        # The offset limit also bounds offset plus peak voltage
+        self.amplituderange=dict()
+        self.amplituderange["VPP"]=(1e-3,10.0)
+        self.amplituderange["VRMS"]=(3.6e-4,3.535)
+        self.amplituderange["DBM"]=(-56.0,23.97)
+        self.offsetrange=(-5.0,5.0)
         self.readresponse=True
-        self.ser_read_thread=threading.Thread(target=self.ser_read_thread)
-        self.ser_read_thread.start()
+        self.replytimeout=1
+        self.timeouts=ReplyTimeouts()
+        self.retries=1
+        self.timedout=0
+        self.strays=0
+        self.late=0
+        self.resyncs=0
+        self.marker=None
+        self.inputbuffer=256
+        # batch() and capture() only apply to the thread that opened them
+        self.local=threading.local()
+        self.batchcmds=None
+        self.capturecmds=None
+        self.shadow=None
+        self.coalescer=None
+        self.stats=None
+        self.prehooks=[]
+        self.posthooks=[]
+        self.observing=False
+        self.window=collections.deque(maxlen=1024)
+        self.errorprobe=4
+        self.dacrange=(-511,511)
+        self.awpoints=4096
+        self.dacbyteorder='big'
+        self.channels=(1,)
+        self.opencon(dev)
         
+    @property
+    def batchcmds(self):
+        return getattr(self.local, 'batchcmds', None)
+    
+    @batchcmds.setter
+    def batchcmds(self, cmds):
+        self.local.batchcmds=cmds
+    
+    @property
+    def capturecmds(self):
+        return getattr(self.local, 'capturecmds', None)
+    
+    @capturecmds.setter
+    def capturecmds(self, cmds):
+        self.local.capturecmds=cmds
+    
     def opencon(self,dev):
-        self.ser = serial.Serial(port=dev,
-                                 baudrate=9600,
-                                 bytesize=serial.EIGHTBITS,
-                                 parity=serial.PARITY_NONE,
-                                 stopbits=serial.STOPBITS_ONE,
-                                 timeout=0.1)
-        
-        self.buf = io.TextIOWrapper(io.BufferedRWPair(self.ser, self.ser, 33554432), newline='\r', line_buffering = True)
+        """Opens 'dev' (see open_transport), or takes over 'dev' if it is an already open connection"""
+        self.ser = open_transport(dev)
+        if not hasattr(self.ser, 'cancel_read'):
+            # the reader cannot be woken up, let it check 'running' regularly
+            self.ser.timeout=0.2
+        self.pending=collections.deque()
+        # 'lock' guards 'pending', 'writelock' the port, so replies are routed during long writes
+        self.lock=threading.Lock()
+        self.writelock=threading.Lock()
+        self.linebuf=bytearray()
+        self.running=True
+        self.reader=threading.Thread(target=self.ser_read_thread, daemon=True)
+        self.reader.start()
     
     def closecon(self):
+        """Stops the reader thread and closes the port.
+        Queries still waiting for a reply return None"""
+        self.flush_coalesced()
+        self.running=False
+        if hasattr(self.ser, 'cancel_read'):
+            self.ser.cancel_read()
+        self.reader.join()
         self.ser.close()
+        with self.lock:
+            while self.pending:
+                self.pending.popleft().set_result(None)
         
     def ignore_serial_read(self,ignore):
         self.readresponse= not ignore
     
     def ser_read_thread(self):
-        while True:
-            if not self.readresponse:
-                line=self.buf.readline()
+        """Blocks on the port and hands each complete reply line to the oldest pending query.
+        Lines nobody waits for (e.g. while ignoring serial reads) are dropped"""
+        while self.running:
+            try:
+                data=self.ser.read(max(1, self.ser.in_waiting))
+            except (serial.SerialException, OSError, TypeError):
+                break
+            self.feed(data)
+    
+    def feed(self, data):
+        """Splits received bytes into reply lines and routes them.
+        'linebuf' is reused and only keeps the incomplete last line"""
+        buf=self.linebuf
+        buf+=data
+        end=max(data.rfind(b'\n'), data.rfind(b'\r'))
+        if end < 0:
+            return
+        end+=len(buf)-len(data)
+        for line in buf[:end].replace(b'\r', b'\n').split(b'\n'):
+            line=line.strip()
+            if line:
+                self.route_reply(line.decode('ascii', errors='replace'))
+        del buf[:end+1]
+    
+    def route_reply(self, reply):
+        with self.lock:
+            if not self.pending:
+                # nobody is waiting, e.g. a reply that came after its timeout
+                self.strays+=1
+                return
+            if self.pending[0] is self.marker and not self.identifies(reply):
+                # late replies in front of the resync handshake
+                self.late+=1
+                return
+            fut=self.pending.popleft()
+        if not fut.done():
+            fut.set_result(reply)
 
-    def msg(self, msg):
-        self.buf.write(msg+'\n')
-        if self.readresponse:
-            lines=self.buf.readlines()
-            if len(lines)>0:
-                return lines[0].strip()
+    def send(self, msg, fut=None, data=None):
+        """Writes 'msg' and queues 'fut' to receive its reply line.
+        'data' is 'msg' already encoded with terminator, e.g. from encode_lines()"""
+        if data is None:
+            data=(msg+'\r').encode('ascii')
+        done=self.observe(msg, len(data)) if self.observing else None
+        self.window.append(msg)
+        self.timeouts.sent(msg)
+        self.transmit(data, fut)
+        if done is not None:
+            if fut is None:
+                done(None)
             else:
-                return lines
-        else:
-            return ['']
+                fut.add_done_callback(done)
+    
+    def transmit(self, data, fut=None):
+        """Writes bytes 'data' and queues 'fut' to receive the reply line"""
+        with self.writelock:
+            if fut is not None:
+                fut.sent=time.perf_counter()
+                with self.lock:
+                    self.pending.append(fut)
+            self.ser.write(data)
+    
+    def wait_reply(self, fut, msg=None):
+        """Waits for the reply routed to 'fut' of query 'msg', None if it does not arrive in time.
+        The timeout is learned per command from send to reply (see ReplyTimeouts), 'replytimeout' until there are replies to learn from.
+        After a timeout the reply stream is resynchronized, then idempotent queries are sent again up to 'retries' times"""
+        t0=time.perf_counter()
+        try:
+            for attempt in range(self.retries+1):
+                try:
+                    value=fut.result(self.timeouts.timeout(msg or '', self.replytimeout))
+                except futures.TimeoutError:
+                    with self.lock:
+                        answered=fut not in self.pending
+                        if not answered:
+                            self.pending.remove(fut)
+                    if answered:
+                        # the reply arrived right after the timeout, it is being handed over
+                        value=fut.result()
+                        if msg is not None:
+                            self.timeouts.learn(msg, time.perf_counter()-fut.sent)
+                        return value
+                    self.timedout+=1
+                    handshake=self.resync()
+                    self.timeouts.backoff(msg or '', self.replytimeout, handshake or 0.0)
+                    if handshake is None or msg is None or not self.idempotent(msg) or attempt == self.retries:
+                        fut.cancel()
+                        return None
+                    self.transmit((msg+'\r').encode('ascii'), fut)
+                    continue
+                if msg is not None:
+                    self.timeouts.learn(msg, time.perf_counter()-fut.sent)
+                return value
+        finally:
+            if self.stats is not None:
+                self.stats.wait(time.perf_counter()-t0)
+    
+    def identifies(self, reply):
+        """Returns True if 'reply' is an *IDN? reply, which ends a resync"""
+        return ',AFG-' in reply.upper()
+    
+    def idempotent(self, msg):
+        """Returns True if 'msg' consists only of queries that can be repeated without side effects"""
+        return all(is_query(part) and command_key(part) != 'SYST:ERR?' for part in msg.split(';'))
+    
+    def resync(self):
+        """Brings the reply stream back in step after a timeout: discards buffered input and all pending
+        queries (they return None), sends *IDN? and drops every line until its reply arrives.
+        Returns the seconds that took, None if it failed"""
+        marker=self.new_future()
+        t0=time.perf_counter()
+        with self.writelock:
+            with self.lock:
+                stale=list(self.pending)
+                self.pending.clear()
+                if hasattr(self.ser, 'reset_input_buffer'):
+                    self.ser.reset_input_buffer()
+                self.marker=marker
+                self.pending.append(marker)
+            self.ser.write(b'*IDN?\r')
+        self.resyncs+=1
+        for fut in stale:
+            if not fut.done():
+                fut.set_result(None)
+        try:
+            marker.result(self.timeouts.maximum)
+            return time.perf_counter()-t0
+        except futures.TimeoutError:
+            with self.lock:
+                if marker in self.pending:
+                    self.pending.remove(marker)
+            return None
+        finally:
+            self.marker=None
+    
+    def new_future(self):
+        """Returns a Future for a pending reply"""
+        return Future()
+    
+    def result(self, value):
+        """Returns 'value' as result of a command that was answered without waiting"""
+        return value
+
+    def msg(self, msg, data=None):
+        """Sends 'msg' to the device, as bytes 'data' if given (the line already encoded, e.g. by Command).
+        Set commands return right after the write, queries wait for their reply line
+        (None if no reply arrives in time, see wait_reply()).
+        Inside a batch() block the command is buffered, queries then return a Future.
+        With shadow state enabled, cached queries and redundant set commands are not sent.
+        With coalescing enabled, set commands may be held back and replaced by later ones.
+        Inside a capture() block the command is only recorded"""
+        if self.capturecmds is not None:
+            self.capturecmds.append(msg)
+            return None
+        query=self.readresponse and is_query(msg)
+        shadow=self.shadow
+        if shadow is not None:
+            if query:
+                value=shadow.get(msg)
+                if value is not None:
+                    return self.deferred(value) if self.batchcmds is not None else self.result(value)
+            elif not shadow.set(msg):
+                return self.result(None)
+        coalescer=self.coalescer
+        if coalescer is not None and self.batchcmds is None:
+            if not query and coalescer.coalescible(msg):
+                self.coalesce(msg)
+                return self.result(None)
+            self.flush_coalesced()
+        fut=self.new_future() if query else None
+        if fut is not None and shadow is not None:
+            fut.add_done_callback(lambda f: f.cancelled() or shadow.read(msg, f.result()))
+        if self.batchcmds is not None:
+            self.batchcmds.append((msg, fut))
+            return fut
+        self.send(msg, fut, data)
+        return self.wait_reply(fut, msg) if fut is not None else self.result(None)
+    
+    def typed(self, result, convert):
+        """Returns reply 'result' converted by convert() (None stays None), for a Future a Future of it"""
+        if convert is None or result is None:
+            return result
+        if isinstance(result, Future):
+            fut=self.new_future()
+            def done(f):
+                if f.cancelled():
+                    fut.cancel()
+                    return
+                try:
+                    fut.set_result(None if f.result() is None else convert(f.result()))
+                except ValueError as e:
+                    fut.set_exception(e)
+            result.add_done_callback(done)
+            return fut
+        return convert(result)
+    
+    def deferred(self, value):
+        """Returns a Future already resolved to 'value'"""
+        fut=self.new_future()
+        fut.set_result(value)
+        return fut
+    
+    # Shadow state
+    ###################
+    def use_shadow_state(self, enable=True):
+        """Enables or disables the client-side shadow state.
+        While enabled the last value set or read for function, frequency, amplitude, offset,
+        duty cycle, symmetry, output, load and voltage units is kept in memory: getters for these are
+        answered from it and setters that would not change it are not sent.
+        Reset, recall and apply commands clear it. Changes made on the front panel are not seen"""
+        self.shadow=ShadowState() if enable else None
+    
+    def invalidate_shadow_state(self):
+        """Forgets all cached values, e.g. after the device was operated manually"""
+        if self.shadow is not None:
+            self.shadow.clear()
+    
+    # Coalescing
+    ###################
+    def use_coalescing(self, rate=20):
+        """Enables (rate in writes per second) or disables (None) coalescing of set commands.
+        While enabled, set commands that change a single parameter are held back and only the latest
+        per parameter and channel is written, at most 'rate' times per second, e.g. for sliders.
+        Queries and all other commands first write what is held back, so they see a consistent state"""
+        if self.coalescer is not None:
+            self.flush_coalesced()
+        self.coalescer=Coalescer(1/rate) if rate else None
+    
+    def coalesce(self, msg):
+        """Holds back set command 'msg', writes it now if the last write is long enough ago"""
+        coalescer=self.coalescer
+        with coalescer.lock:
+            coalescer.add(msg)
+            wait=coalescer.last+coalescer.interval-time.monotonic()
+            if wait <= 0:
+                self.flush_coalesced()
+            elif not coalescer.scheduled:
+                coalescer.scheduled=True
+                self.call_later(wait, self.flush_coalesced)
+    
+    def flush_coalesced(self):
+        """Writes the set commands held back by coalescing"""
+        coalescer=self.coalescer
+        if coalescer is None:
+            return
+        with coalescer.lock:
+            coalescer.scheduled=False
+            if not coalescer.pending:
+                return
+            for line, futs in self.batch_lines((msg, None) for msg in coalescer.take()):
+                self.send(line)
+    
+    def call_later(self, delay, func):
+        """Runs func() after 'delay' seconds from a timer thread"""
+        timer=threading.Timer(delay, func)
+        timer.daemon=True
+        timer.start()
+    
+    # Instrumentation
+    ###################
+    def use_stats(self, enable=True):
+        """Enables or disables per command statistics (see CommandStats), returns the CommandStats"""
+        self.stats=CommandStats() if enable else None
+        self.update_observing()
+        return self.stats
+    
+    def stats_snapshot(self):
+        """Returns a copy of the command statistics, None if disabled"""
+        return self.stats.snapshot() if self.stats is not None else None
+    
+    def stats_prometheus(self, prefix='arbitrage', labels=None):
+        """Returns the command statistics in Prometheus text format, '' if disabled"""
+        return self.stats.prometheus(prefix, labels) if self.stats is not None else ''
+    
+    def add_hook(self, pre=None, post=None):
+        """Registers pre(msg), called before 'msg' is written, and post(msg, reply, seconds),
+        called when it completed: after the write for set commands, when the reply arrived
+        (None on timeout) for queries. Hooks of queries may run in the reader thread"""
+        if pre is not None:
+            self.prehooks.append(pre)
+        if post is not None:
+            self.posthooks.append(post)
+        self.update_observing()
+    
+    def remove_hook(self, pre=None, post=None):
+        if pre in self.prehooks:
+            self.prehooks.remove(pre)
+        if post in self.posthooks:
+            self.posthooks.remove(post)
+        self.update_observing()
+    
+    def update_observing(self):
+        self.observing=self.stats is not None or bool(self.prehooks) or bool(self.posthooks)
+    
+    def observe(self, msg, written):
+        """Runs the pre hooks for 'msg' and returns a callback that records it once it completed"""
+        for hook in self.prehooks:
+            hook(msg)
+        t0=time.perf_counter()
+        stats=self.stats
+        posthooks=self.posthooks
+        def done(fut):
+            seconds=time.perf_counter()-t0
+            timeout=fut is not None and fut.cancelled()
+            reply=fut.result() if fut is not None and not timeout else None
+            if stats is not None:
+                stats.record_line(msg, seconds, written, reply, timeout, fut is not None and not timeout and reply is None)
+            for hook in posthooks:
+                hook(msg, reply, seconds)
+        return done
+    
+    # Capturing
+    ###################
+    @contextlib.contextmanager
+    def capture(self):
+        """Records the commands issued inside the 'with' block instead of sending them.
+        Yields the list of recorded commands, e.g. to pre-encode them with encode_lines().
+        Commands from other threads are sent as usual"""
+        saved, self.capturecmds = self.capturecmds, []
+        try:
+            yield self.capturecmds
+        finally:
+            self.capturecmds=saved
+    
+    def encode_lines(self, cmds):
+        """Returns commands 'cmds' joined as in batch() and encoded to bytes, ready for send()"""
+        return [(line+'\r').encode('ascii') for line, futs in self.batch_lines((msg, None) for msg in cmds)]
+    
+    # Batching
+    ###################
+    @contextlib.contextmanager
+    def batch(self):
+        """Buffers all commands sent inside the 'with' block and writes them, joined by ';',
+        in as few lines as 'inputbuffer' allows when the block exits.
+        Queries inside the block return a Future that is resolved once the batch is flushed.
+        If the block raises, nothing is sent and the Futures are cancelled.
+        Commands from other threads (e.g. a CounterStream) are not buffered"""
+        if self.batchcmds is not None:
+            yield self
+            return
+        self.flush_coalesced()
+        self.batchcmds=[]
+        try:
+            yield self
+        except BaseException:
+            for msg, fut in self.batchcmds:
+                if fut is not None:
+                    fut.cancel()
+            self.invalidate_shadow_state()
+            raise
+        finally:
+            cmds, self.batchcmds = self.batchcmds, None
+        self.flush_batch(cmds)
+    
+    def batch_lines(self, cmds):
+        """Joins (msg, fut) pairs into ';'-separated lines of at most 'inputbuffer' bytes.
+        Yields (line, futs) with the Futures of the queries in each line"""
+        line, futs = '', []
+        for msg, fut in cmds:
+            # a leading ':' resets the SCPI header path after the ';'
+            part=msg if msg.startswith('*') else ':'+msg.lstrip(':')
+            if line and len(line)+1+len(part)+1 > self.inputbuffer:
+                yield line, futs
+                line, futs = '', []
+            line=line+';'+part if line else part
+            if fut is not None:
+                futs.append(fut)
+        if line:
+            yield line, futs
+    
+    def split_reply(self, reply, futs):
+        """Resolves 'futs' with the ';'-separated fields of 'reply' (None if missing)"""
+        fields=reply.split(';', len(futs)-1) if reply is not None else []
+        for i, fut in enumerate(futs):
+            if not fut.done():
+                fut.set_result(fields[i] if i < len(fields) else None)
+    
+    def flush_batch(self, cmds):
+        """Writes (msg, fut) pairs as ';'-joined lines and resolves the Futures of the queries"""
+        sent=[]
+        for line, futs in self.batch_lines(cmds):
+            linefut=self.new_future() if futs else None
+            self.send(line, linefut)
+            sent.append((line, linefut, futs))
+        for line, linefut, futs in sent:
+            if linefut is not None:
+                self.split_reply(self.wait_reply(linefut, line), futs)
+
+
+    # Fences
+    ###################
+    def sync(self):
+        """Fence: waits until the device has processed everything sent so far (*OPC?), then drains
+        its error queue, 'errorprobe' SYST:ERR? queries per round trip.
+        Raises CommandError if there were errors, listing the commands sent since the previous fence.
+        The device does not tell which command failed, smaller windows narrow it down"""
+        if self.capturecmds is not None:
+            return
+        self.flush_coalesced()
+        if self.batchcmds:
+            cmds, self.batchcmds = self.batchcmds, []
+            self.flush_batch(cmds)
+        commands=self.window_commands()
+        errors=[]
+        first=True
+        while True:
+            replies=[fut.result() for fut in self.fence_round(first)]
+            if first and replies.pop(0) is None:
+                errors.append((None, 'No reply to *OPC?'))
+            first=False
+            if not self.collect_errors(replies, errors):
+                break
+        self.window.clear()
+        if errors:
+            raise CommandError(errors, commands)
+    
+    @contextlib.contextmanager
+    def fence(self):
+        """Runs sync() when the 'with' block exits without exception,
+        so the commands sent inside the block form one window.
+        Errors still queued from before the block are reported with it, sync() first if that matters"""
+        self.window.clear()
+        yield self
+        self.sync()
+    
+    def window_commands(self):
+        """Returns the commands sent since the previous fence, batch lines split into their commands"""
+        return [cmd.lstrip(':') for line in self.window for cmd in line.split(';')]
+    
+    def fence_round(self, first):
+        """Sends *OPC? (in the first round) and 'errorprobe' SYST:ERR? queries as one line, returns their Futures"""
+        msgs=(['*OPC?'] if first else [])+['SYST:ERR?']*self.errorprobe
+        cmds=[(msg, self.new_future()) for msg in msgs]
+        self.flush_batch(cmds)
+        return [fut for msg, fut in cmds]
+    
+    def collect_errors(self, replies, errors):
+        """Appends the (code, text) of the errors in SYST:ERR? 'replies' to 'errors'.
+        Returns True if the queue may hold more"""
+        for reply in replies:
+            if reply is None:
+                errors.append((None, 'No reply to SYST:ERR?'))
+                return False
+            code, _, text = reply.partition(',')
+            try:
+                code=int(code)
+            except ValueError:
+                code=None
+            if code == 0:
+                return False
+            errors.append((code, text.strip().strip('"')))
+        return True
+    
+    def frequency_limits(self, func=None, chan=1):
+        """Returns the (min, max) frequency for function 'func'.
+        Without 'func' the function known from the shadow state is used, else the widest range of the model"""
+        if func is None and self.shadow is not None:
+            func=self.shadow.get('SOURCE'+str(chan)+':FUNC?')
+        key=functionranges.get(func.upper().strip('"') if func else None)
+        if key in self.frequencyrange:
+            return self.frequencyrange[key]
+        return (min(r[0] for r in self.frequencyrange.values()), max(r[1] for r in self.frequencyrange.values()))
+    
+    def known(self, query):
+        """Returns the value of 'query' from the shadow state as upper case text, None if not known"""
+        value=self.shadow.get(query) if self.shadow is not None else None
+        return value.strip().strip('"').upper() if value is not None else None
+    
+    def load_factors(self):
+        """Voltage factors of the possible output loads, 2 for high impedance"""
+        load=self.known('OUTP:LOAD?')
+        return (2,) if load == 'INF' else (1,) if load == 'DEF' else (1, 2)
+    
+    def amplitude_limits(self, unit=None, chan=1, offset=None):
+        """Returns the (min, max) amplitude in 'unit' (VPP, VRMS or DBM).
+        Unit, output load and, for Vpp, the 'offset' that leaves less headroom are taken from the
+        shadow state if not given. What is not known gives the widest range"""
+        if unit is None:
+            unit=self.known('SOURCE'+str(chan)+':VOLT:UNIT?')
+        units=[unit] if unit in self.amplituderange else list(self.amplituderange)
+        if offset is None and unit == 'VPP':
+            offset=self.known('SOURCE'+str(chan)+':DCO?')
+        lo, hi = [], []
+        for u in units:
+            for factor in self.load_factors():
+                low, high = self.amplituderange[u]
+                if u != 'DBM':
+                    low, high = low*factor, high*factor
+                if u == 'VPP' and offset is not None:
+                    high=min(high, 2*(self.offsetrange[1]*factor-abs(float(offset))))
+                lo.append(low)
+                hi.append(high)
+        return (min(lo), max(hi))
+    
+    def offset_limits(self, amp=None, chan=1):
+        """Returns the (min, max) DC offset, narrowed by half the amplitude 'amp' in Vpp.
+        Output load and amplitude (if its unit is VPP) are taken from the shadow state if not given"""
+        if amp is None and self.known('SOURCE'+str(chan)+':VOLT:UNIT?') == 'VPP':
+            amp=self.known('SOURCE'+str(chan)+':AMPL?')
+        headroom=float(amp)/2 if amp is not None else 0.0
+        factor=max(self.load_factors())
+        return (self.offsetrange[0]*factor+headroom, self.offsetrange[1]*factor-headroom)
 
 
     ##############################
     #          COMMANDS          #
     ##############################
+    # Most commands are generated from 'basecommands', see install()
 
-
-    # System commands
-    ###################
-    def identify(self):
-        """Returns the function generator manufacturer, model number, serial number and firmware version number"""
-        return self.msg('*idn?')
-    
-    def reset(self):
-        """Reset the function generator to its factory default state"""
-        return self.msg('*rst')
-    
-    def clear(self):
-        """clears all the event registers, the error queue and cancels an *OPC command"""
-        return self.msg('*rst')
-    
     # Apply commands
     ###################
-    def apply_func(self, func='SIN', freq=100, amp=0.1, off=0, chan=1):
-        """Instructs device to output function 'func' at channel 'chan' with frequency 'freq', amplitude 'amp' and offset 'off'
-        'func' can be SIN, SQUARE, RAMP, NOISE, USER
-        'freq' in Hz
-        'amp' in V
-        'offs' in V"""
-        return self.msg('SOURCE'+str(chan)+':APPLY:'+str(func)+' '+str(freq)+','+str(amp)+','+str(off))
-    
     def apply_sine(self,freq=100, amp=0.1, off=0, chan=1):
         """Instructs device to output sine function at channel 'chan' with frequency 'freq', amplitude 'amp' and offset 'off'
         'freq' in Hz
@@ -164,95 +1379,8 @@ class AFGbase():
         'offs' in V"""
         return self.apply_func(chan=chan, func='USER', freq=freq, amp=amp, off=off)
     
-    def get_apply(self,chan=1):
-        """return current function settings"""
-        return self.msg('SOURCE'+str(chan)+':APPLY?')
-    
-    # Function commands
-    #####################
-    def set_func(self, func='SIN', chan=1):
-        """Instructs device to change output function of channen 'chan'
-        func can be SIN, SQUARE, RAMP, NOISE, USER"""
-        return self.msg('SOURCE'+str(chan)+':FUNC '+str(func))
-    
-    def get_func(self, chan=1):
-        """Returns currently set function"""
-        return self.msg('SOURCE'+str(chan)+':FUNC?')
-    
-    # Frequency commands
-    #####################
-    def set_freq(self, freq=100, chan=1):
-        """Instructs device to change output frequency of channel 'chan'
-        frequ can be a number or 'MIN' or 'MAX' """
-        return self.msg('SOURCE'+str(chan)+':FREQ '+str(freq))
-    
-    def get_freq(self, chan=1):
-        """Returns currently set frequency"""
-        return self.msg('SOURCE'+str(chan)+':FREQ?')
-    
-    # Amplitude commands
-    #####################
-    def set_amp(self, amp=0.1, chan=1):
-        """Instructs device to change output amplitude of channel 'chan'
-        amp can be a number or 'MIN' or 'MAX' """
-        return self.msg('SOURCE'+str(chan)+':AMPL '+str(amp))
-    
-    def get_amp(self, chan=1):
-        """Returns currently set amplitude"""
-        return self.msg('SOURCE'+str(chan)+':AMPL?')
-    
-    # DC Offset commands
-    #####################
-    def set_offset(self, offset=0, chan=1):
-        """Instructs device to change output dc offset of channel 'chan'
-        offset can be a number or 'MIN' or 'MAX' """
-        return self.msg('SOURCE'+str(chan)+':DCO '+str(offset))
-    
-    def get_offset(self, chan=1):
-        """Returns currently set dc offset"""
-        return self.msg('SOURCE'+str(chan)+':DCO?')
-    
-    # SQUARE Duty cycle commands
-    #####################
-    def set_square_dutycycle(self, duty=50, chan=1):
-        """Instructs device to change duty cycle of square function on channel 'chan'
-        duty can be a number (in percent) or 'MIN' or 'MAX' """
-        return self.msg('SOURCE'+str(chan)+':SQUARE:DCYCLE '+str(duty))
-    
-    def get_square_dutycycle(self, chan=1):
-        """Returns currently set square function duty cycle"""
-        return self.msg('SOURCE'+str(chan)+':SQUARE:DCYCLE?')
-    
-    # RAMP symmetry commands
-    #####################
-    def set_ramp_symmetry(self, sym=50, chan=1):
-        """Instructs device to change symmetry of ramp function on channel 'chan'
-        sym can be a number (in percent) or 'MIN' or 'MAX' """
-        return self.msg('SOURCE'+str(chan)+':RAMP:SYMM '+str(sym))
-    
-    def get_ramp_symmetry(self, chan=1):
-        """Returns currently set ramp symmetry"""
-        return self.msg('SOURCE'+str(chan)+':RAMP:SYMM?')
-    
-    # output commands
-    #####################
-    def set_output_enabled(self, enable=False):
-        """Turn on or off output"""
-        return self.msg('OUTP '+str("ON" if enable else "OFF"))
-    
-    def get_output_enabled(self):
-        """Returns if device output state"""
-        return self.msg('OUTP?')
-    
     # output load commands
     #####################
-    def set_output_load(self, load="DEF"):
-        """Set output load to 50ohm (DEF) or HighZ (INF)"""
-        if load.upper() in ["DEF","INF"]:
-            return self.msg('OUTP:LOAD '+str(load))
-        else:
-            raise RangeException
-    
     def set_output_load_50ohm(self):
         """Set output load to 50ohm"""
         return self.set_output_load(load="DEF")
@@ -261,19 +1389,8 @@ class AFGbase():
         """Set output load to HighZohm"""
         return self.set_output_load(load="INF")
     
-    def get_output_load(self):
-        """Returns if device output load state"""
-        return self.msg('OUTP:LOAD?')
-    
     # volt units commands
     #####################
-    def set_volt_units(self, unit="VPP", chan=1):
-        """Set voltage units to Vpp, Vrms of dBm"""
-        if unit.upper() in ["VPP","VRMS","DBM"]:
-            return self.msg('SOURCE'+str(chan)+':VOLT:UNIT '+str(unit))
-        else:
-            raise RangeException
-    
     def set_volt_units_vpp(self, chan=1):
         """Set voltage units to vpp"""
         return self.set_volt_units(unit="VPP", chan=chan)
@@ -286,41 +1403,67 @@ class AFGbase():
         """Set voltage units to vdbm"""
         return self.set_volt_units(unit="DBM", chan=chan)
     
-    def get_volt_units(self, chan=1):
-        """Returns current output voltage units of channel chan"""
-        return self.msg('SOURCE'+str(chan)+':VOLT:UNIT?')
-    
-    # Save and recall commands
-    #####################
-    # save and recall commands
-    #####################
-    def save_state(self, reg=0):
-        """Saves current device state to register reg 0-9,
-        or saves arbitrary waveform to register reg 10-19"""
-        if reg in range(0,20):
-            return self.msg('*SAV '+str(reg))
-        else:
-            raise RangeException
-    
-    def recall_state(self, reg=0):
-        """Loads current device state from register reg 0-9,
-        or loads arbitrary waveform from register reg 10-19"""
-        if reg in range(0,20):
-            return self.msg('*RCL '+str(reg))
-        else:
-            raise RangeException
-        
     # Arbitrary waveform commands
     #####################
     # AW data dac commands
     #####################
-    def set_aw_dac(self, block="-511, -206, 0, 206, 511, 206, 0, -206"):
-        """Loads 'block' into memory
+    def set_aw_dac(self, block="-511, -206, 0, 206, 511, 206, 0, -206", start=0, progress=None, chunksize=256):
+        """Loads 'block' into memory, starting at point 'start'
         block can be:
         -list of values, comma separated. E.g. "-511, -206, 0, 206, 511, 206, 0, -206"
-        -binary data: format #216 dat
-        where dat is 16 bit binary data"""
-        return self.msg('DATA:DAC VOLATILE, 0, '+str(block))
+        -NumPy integer array, any buffer or sequence of ints in 'dacrange',
+         or a DacBlock as returned by waveform.encode().
+        These are sent as IEEE 488.2 binary block (#<n><len><data>) of 16 bit words in 'dacbyteorder',
+        streamed in 'chunksize' byte chunks. After each chunk progress(sent, total, bytes_per_second)
+        is called if given, from a helper thread: commands it issues are sent after the upload.
+        Returns the achieved bytes per second.
+        Inside a capture() block the upload is recorded as the equivalent text command"""
+        if isinstance(block, str):
+            return self.msg('DATA:DAC VOLATILE, '+str(start)+', '+block)
+        data=dac_block(block, self.dacrange, self.dacbyteorder)
+        if self.capturecmds is not None:
+            self.capture_dac(data, start)
+            return None
+        self.flush_coalesced()
+        if self.batchcmds:
+            cmds, self.batchcmds = self.batchcmds, []
+            self.flush_batch(cmds)
+        total=len(data)
+        header=('DATA:DAC VOLATILE, '+str(start)+', ').encode('ascii')+block_header(total)
+        done=self.observe('DATA:DAC', len(header)+total+1) if self.observing else None
+        self.window.append('DATA:DAC VOLATILE, '+str(start)+', <'+str(total)+' bytes>')
+        self.timeouts.sent('DATA:DAC')
+        # nothing may come between the block's bytes, so the port stays locked for the whole upload
+        # and progress() runs outside of it
+        reports=futures.ThreadPoolExecutor(1) if progress is not None else None
+        calls=[]
+        try:
+            with self.writelock:
+                t0=time.monotonic()
+                self.ser.write(header)
+                rate=0
+                for sent in range(0, total, chunksize):
+                    self.ser.write(data[sent:sent+chunksize])
+                    self.ser.flush()
+                    rate=min(sent+chunksize, total)/max(time.monotonic()-t0, 1e-9)
+                    if reports is not None:
+                        calls.append(reports.submit(progress, min(sent+chunksize, total), total, rate))
+                self.ser.write(b'\r')
+        finally:
+            if reports is not None:
+                reports.shutdown()
+        if done is not None:
+            done(None)
+        for call in calls:
+            call.result()
+        return rate
+    
+    def capture_dac(self, data, start):
+        """Records the upload of DAC words 'data' at 'start' in the capture() block, as text command"""
+        words=array.array('h', bytes(data))
+        if sys.byteorder != self.dacbyteorder:
+            words.byteswap()
+        self.capturecmds.append('DATA:DAC VOLATILE, '+str(start)+', '+', '.join(map(str, words)))
 
 
 class AFG2000(AFGbase):
@@ -331,249 +1474,197 @@ class AFG2100(AFGbase):
     def info(self):
         return("AFG21xx")
     
+    def stream_counter(self, gate=0.1, size=100000):
+        """Enables the frequency counter with gate time 'gate' and polls it in the background.
+        Returns the running counter.CounterStream, which buffers the last 'size' readings"""
+        import counter
+        return counter.CounterStream(self, gate, size).start()
+    # AM, FM, FSK, sweep and counter commands are generated from 'modulationcommands', see install()
+
+
+##############################
+#       COMMAND TABLES       #
+##############################
+functions=('SIN','SQUARE','SQU','RAMP','NOISE','NOIS','USER')
+modfunctions=('SIN','SQUARE','SQU','RAMP')
+# frequencyrange key for each function
+functionranges={'SIN':'Sine', 'SQUARE':'Square', 'SQU':'Square', 'RAMP':'Ramp', 'TRIANGLE':'Triangle'}
+
+basecommands=[
+    # System commands
+    Command('identify', '*idn?', [],
+            "Returns the function generator manufacturer, model number, serial number and firmware version number"),
+    Command('reset', '*rst', [],
+            "Reset the function generator to its factory default state"),
+    Command('clear', '*cls', [],
+            "clears all the event registers, the error queue and cancels an *OPC command"),
+    # Apply commands
+    Command('apply_func', 'SOURCE{chan}:APPLY:{func} {freq},{amp},{off}',
+            [Enum('func', 'SIN', functions), Number('freq', 100, frequency_limits),
+             Number('amp', 0.1, amplitude_limits), Number('off', 0, offset_limits), Chan()],
+            """Instructs device to output function 'func' at channel 'chan' with frequency 'freq', amplitude 'amp' and offset 'off'
+        'func' can be SIN, SQUARE, RAMP, NOISE, USER
+        'freq' in Hz
+        'amp' in V
+        'offs' in V"""),
+    Command('get_apply', 'SOURCE{chan}:APPLY?', [Chan()],
+            "return current function settings", to_apply),
+    # Function commands
+    Command('set_func', 'SOURCE{chan}:FUNC {func}', [Enum('func', 'SIN', functions), Chan()],
+            """Instructs device to change output function of channen 'chan'
+        func can be SIN, SQUARE, RAMP, NOISE, USER"""),
+    Command('get_func', 'SOURCE{chan}:FUNC?', [Chan()],
+            "Returns currently set function", to_enum(Function)),
+    # Frequency commands
+    Command('set_freq', 'SOURCE{chan}:FREQ {freq}', [Number('freq', 100, frequency_limits), Chan()],
+            """Instructs device to change output frequency of channel 'chan'
+        frequ can be a number or 'MIN' or 'MAX' """),
+    Command('get_freq', 'SOURCE{chan}:FREQ?', [Chan()],
+            "Returns currently set frequency", to_float),
+    # Amplitude commands
+    Command('set_amp', 'SOURCE{chan}:AMPL {amp}', [Number('amp', 0.1, amplitude_limits), Chan()],
+            """Instructs device to change output amplitude of channel 'chan'
+        amp can be a number or 'MIN' or 'MAX' """),
+    Command('get_amp', 'SOURCE{chan}:AMPL?', [Chan()],
+            "Returns currently set amplitude", to_float),
+    # DC Offset commands
+    Command('set_offset', 'SOURCE{chan}:DCO {offset}', [Number('offset', 0, offset_limits), Chan()],
+            """Instructs device to change output dc offset of channel 'chan'
+        offset can be a number or 'MIN' or 'MAX' """),
+    Command('get_offset', 'SOURCE{chan}:DCO?', [Chan()],
+            "Returns currently set dc offset", to_float),
+    # SQUARE Duty cycle commands
+    Command('set_square_dutycycle', 'SOURCE{chan}:SQUARE:DCYCLE {duty}', [Number('duty', 50, (0, 100)), Chan()],
+            """Instructs device to change duty cycle of square function on channel 'chan'
+        duty can be a number (in percent) or 'MIN' or 'MAX' """),
+    Command('get_square_dutycycle', 'SOURCE{chan}:SQUARE:DCYCLE?', [Chan()],
+            "Returns currently set square function duty cycle", to_float),
+    # RAMP symmetry commands
+    Command('set_ramp_symmetry', 'SOURCE{chan}:RAMP:SYMM {sym}', [Number('sym', 50, (0, 100)), Chan()],
+            """Instructs device to change symmetry of ramp function on channel 'chan'
+        sym can be a number (in percent) or 'MIN' or 'MAX' """),
+    Command('get_ramp_symmetry', 'SOURCE{chan}:RAMP:SYMM?', [Chan()],
+            "Returns currently set ramp symmetry", to_float),
+    # output commands
+    Command('set_output_enabled', 'OUTP {enable}', [Switch('enable', False)],
+            "Turn on or off output"),
+    Command('get_output_enabled', 'OUTP?', [],
+            "Returns if device output state", to_bool),
+    # output load commands
+    Command('set_output_load', 'OUTP:LOAD {load}', [Enum('load', 'DEF', ('DEF','INF'))],
+            "Set output load to 50ohm (DEF) or HighZ (INF)"),
+    Command('get_output_load', 'OUTP:LOAD?', [],
+            "Returns if device output load state", to_enum(Load)),
+    # volt units commands
+    Command('set_volt_units', 'SOURCE{chan}:VOLT:UNIT {unit}', [Enum('unit', 'VPP', ('VPP','VRMS','DBM')), Chan()],
+            "Set voltage units to Vpp, Vrms of dBm"),
+    Command('get_volt_units', 'SOURCE{chan}:VOLT:UNIT?', [Chan()],
+            "Returns current output voltage units of channel chan", to_enum(VoltUnit)),
+    # save and recall commands
+    Command('save_state', '*SAV {reg}', [Int('reg', 0, (0, 19))],
+            """Saves current device state to register reg 0-9,
+        or saves arbitrary waveform to register reg 10-19"""),
+    Command('recall_state', '*RCL {reg}', [Int('reg', 0, (0, 19))],
+            """Loads current device state from register reg 0-9,
+        or loads arbitrary waveform from register reg 10-19"""),
+]
+
+modulationcommands=[
     # AM commands
-    #####################
-    # AM state commands
-    #####################
-    def set_am_state(self, enable=True, chan=1):
-        """Enables of disables amplitude modulation"""
-        return self.msg('SOURCE'+str(chan)+':AM:STATE '+str("ON" if enable else "OFF"))
-    
-    def get_am_state(self, chan=1):
-        """Returns if amplitude modulation is enabled or not"""
-        return self.msg('SOURCE'+str(chan)+':AM:STATE?')
-    
-    # AM source commands
-    #####################
-    def set_am_source(self, src="INT", chan=1):
-        """Sets AM source to INTernal or EXTernal"""
-        if src.upper() in ['INT','EXT']:
-            return self.msg('SOURCE'+str(chan)+':AM:SOUR '+str(src))
-        else:
-            raise RangeException
-    
-    def get_am_state(self, chan=1):
-        """Returns current AM source"""
-        return self.msg('SOURCE'+str(chan)+':AM:SOUR?')
-    
-    # AM function commands
-    #####################
-    def set_am_function(self, func="SIN", chan=1):
-        """Sets internal AM source function"""
-        if src.upper() in ['SIN','SQUARE','RAMP']:
-            return self.msg('SOURCE'+str(chan)+':AM:INT:FUNC '+str(func))
-        else:
-            raise RangeException
-    
-    def get_am_function(self, chan=1):
-        """Returns current internal AM source function"""
-        return self.msg('SOURCE'+str(chan)+':AM:INT:FUNC?')
-    
-    # AM frequency commands
-    #####################
-    def set_am_frequency(self, freq=100, chan=1):
-        """Sets internal AM function frequenc. Can be number or MIN or MAX"""
-        return self.msg('SOURCE'+str(chan)+':AM:INT:FREQ '+str(freq))
-        
-    def get_am_frequency(self, chan=1):
-        """Returns current internal AM function frequency"""
-        return self.msg('SOURCE'+str(chan)+':AM:INT:FREQ?')
-    
-    # AM depth commands
-    #####################
-    def set_am_depth(self, depth=100, chan=1):
-        """Sets AM depth in percent (0-120). Can be number or MIN or MAX"""
-        return self.msg('SOURCE'+str(chan)+':AM:DEPT '+str(depth))
-        
-    def get_am_depth(self, chan=1):
-        """Returns current AM depth"""
-        return self.msg('SOURCE'+str(chan)+':AM:DEPT?')
-    
+    Command('set_am_state', 'SOURCE{chan}:AM:STATE {enable}', [Switch('enable', True), Chan()],
+            "Enables of disables amplitude modulation"),
+    Command('get_am_state', 'SOURCE{chan}:AM:STATE?', [Chan()],
+            "Returns if amplitude modulation is enabled or not", to_bool),
+    Command('set_am_source', 'SOURCE{chan}:AM:SOUR {src}', [Enum('src', 'INT', ('INT','EXT')), Chan()],
+            "Sets AM source to INTernal or EXTernal"),
+    Command('get_am_source', 'SOURCE{chan}:AM:SOUR?', [Chan()],
+            "Returns current AM source"),
+    Command('set_am_function', 'SOURCE{chan}:AM:INT:FUNC {func}', [Enum('func', 'SIN', modfunctions), Chan()],
+            "Sets internal AM source function"),
+    Command('get_am_function', 'SOURCE{chan}:AM:INT:FUNC?', [Chan()],
+            "Returns current internal AM source function", to_enum(Function)),
+    Command('set_am_frequency', 'SOURCE{chan}:AM:INT:FREQ {freq}', [Number('freq', 100, (2e-3, 20e3)), Chan()],
+            "Sets internal AM function frequenc. Can be number or MIN or MAX"),
+    Command('get_am_frequency', 'SOURCE{chan}:AM:INT:FREQ?', [Chan()],
+            "Returns current internal AM function frequency", to_float),
+    Command('set_am_depth', 'SOURCE{chan}:AM:DEPT {depth}', [Number('depth', 100, (0, 120)), Chan()],
+            "Sets AM depth in percent (0-120). Can be number or MIN or MAX"),
+    Command('get_am_depth', 'SOURCE{chan}:AM:DEPT?', [Chan()],
+            "Returns current AM depth", to_float),
     # FM commands
-    #####################
-    # FM state commands
-    #####################
-    def set_fm_state(self, enable=True, chan=1):
-        """Enables of disables frequency modulation"""
-        return self.msg('SOURCE'+str(chan)+':FM:STATE '+str("ON" if enable else "OFF"))
-    
-    def get_fm_state(self, chan=1):
-        """Returns if frequency modulation is enabled or not"""
-        return self.msg('SOURCE'+str(chan)+':FM:STATE?')
-    
-    # FM source commands
-    #####################
-    def set_fm_source(self, src="INT", chan=1):
-        """Sets FM source to INTernal or EXTernal"""
-        if src.upper() in ['INT','EXT']:
-            return self.msg('SOURCE'+str(chan)+':FM:SOUR '+str(src))
-        else:
-            raise RangeException
-    
-    def get_fm_state(self, chan=1):
-        """Returns current FM source"""
-        return self.msg('SOURCE'+str(chan)+':FM:SOUR?')
-    
-    # FM function commands
-    #####################
-    def set_fm_function(self, func="SIN", chan=1):
-        """Sets internal FM source function"""
-        if src.upper() in ['SIN','SQUARE','RAMP']:
-            return self.msg('SOURCE'+str(chan)+':FM:INT:FUNC '+str(func))
-        else:
-            raise RangeException
-    
-    def get_fm_function(self, chan=1):
-        """Returns current internal FM source function"""
-        return self.msg('SOURCE'+str(chan)+':FM:INT:FUNC?')
-    
-    # FM frequency commands
-    #####################
-    def set_fm_frequency(self, freq=100, chan=1):
-        """Sets internal FM function frequenc. Can be number or MIN or MAX"""
-        return self.msg('SOURCE'+str(chan)+':FM:INT:FREQ '+str(freq))
-        
-    def get_fm_frequency(self, chan=1):
-        """Returns current internal FM function frequency"""
-        return self.msg('SOURCE'+str(chan)+':FM:INT:FREQ?')
-    
-    # FM deviation commands
-    #####################
-    def set_fm_deviation(self, deviation=100, chan=1):
-        """Sets FM deviation in "peak deviation in Hz". Can be number or MIN or MAX"""
-        return self.msg('SOURCE'+str(chan)+':FM:DEV '+str(deviation))
-        
-    def get_fm_deviation(self, chan=1):
-        """Returns current FM deviation"""
-        return self.msg('SOURCE'+str(chan)+':FM:DEV?')
-    
+    Command('set_fm_state', 'SOURCE{chan}:FM:STATE {enable}', [Switch('enable', True), Chan()],
+            "Enables of disables frequency modulation"),
+    Command('get_fm_state', 'SOURCE{chan}:FM:STATE?', [Chan()],
+            "Returns if frequency modulation is enabled or not", to_bool),
+    Command('set_fm_source', 'SOURCE{chan}:FM:SOUR {src}', [Enum('src', 'INT', ('INT','EXT')), Chan()],
+            "Sets FM source to INTernal or EXTernal"),
+    Command('get_fm_source', 'SOURCE{chan}:FM:SOUR?', [Chan()],
+            "Returns current FM source"),
+    Command('set_fm_function', 'SOURCE{chan}:FM:INT:FUNC {func}', [Enum('func', 'SIN', modfunctions), Chan()],
+            "Sets internal FM source function"),
+    Command('get_fm_function', 'SOURCE{chan}:FM:INT:FUNC?', [Chan()],
+            "Returns current internal FM source function", to_enum(Function)),
+    Command('set_fm_frequency', 'SOURCE{chan}:FM:INT:FREQ {freq}', [Number('freq', 100, (2e-3, 20e3)), Chan()],
+            "Sets internal FM function frequenc. Can be number or MIN or MAX"),
+    Command('get_fm_frequency', 'SOURCE{chan}:FM:INT:FREQ?', [Chan()],
+            "Returns current internal FM function frequency", to_float),
+    Command('set_fm_deviation', 'SOURCE{chan}:FM:DEV {deviation}', [Number('deviation', 100, frequency_limits), Chan()],
+            """Sets FM deviation in "peak deviation in Hz". Can be number or MIN or MAX"""),
+    Command('get_fm_deviation', 'SOURCE{chan}:FM:DEV?', [Chan()],
+            "Returns current FM deviation", to_float),
     # FSK commands
-    #####################
-    # FSK state commands
-    #####################
-    def set_fsk_state(self, enable=True, chan=1):
-        """Enables of disables frequency-shift keying modulation"""
-        return self.msg('SOURCE'+str(chan)+':FSK:STATE '+str("ON" if enable else "OFF"))
-    
-    def get_fsk_state(self, chan=1):
-        """Returns if frequency-shift keying modulation is enabled or not"""
-        return self.msg('SOURCE'+str(chan)+':FSK:STATE?')
-    
-    # FSK source commands
-    #####################
-    def set_fsk_source(self, src="INT", chan=1):
-        """Sets FSK source to INTernal or EXTernal"""
-        if src.upper() in ['INT','EXT']:
-            return self.msg('SOURCE'+str(chan)+':FSK:SOUR '+str(src))
-        else:
-            raise RangeException
-    
-    def get_fsk_state(self, chan=1):
-        """Returns current FSK source"""
-        return self.msg('SOURCE'+str(chan)+':FSK:SOUR?')
-    
-    # FSK frequency commands
-    #####################
-    def set_fsk_frequency(self, freq=100, chan=1):
-        """Sets FSK function frequenc. Can be number or MIN or MAX"""
-        return self.msg('SOURCE'+str(chan)+':FSK:FREQ '+str(freq))
-        
-    def get_fsk_frequency(self, chan=1):
-        """Returns current internal FSK function frequency"""
-        return self.msg('SOURCE'+str(chan)+':FSK:FREQ?')
-    
-    # FSK internal rate commands
-    #####################
-    def set_fsk_internal_rate(self, rate=100, chan=1):
-        """Sets FSK rate for internal sources. Can be number or MIN or MAX"""
-        return self.msg('SOURCE'+str(chan)+':FSK:INT:RATE '+str(rate))
-        
-    def get_fsk_internal_rate(self, chan=1):
-        """Returns current FM depth"""
-        return self.msg('SOURCE'+str(chan)+':FSK:INT:RATE?')
-    
+    Command('set_fsk_state', 'SOURCE{chan}:FSK:STATE {enable}', [Switch('enable', True), Chan()],
+            "Enables of disables frequency-shift keying modulation"),
+    Command('get_fsk_state', 'SOURCE{chan}:FSK:STATE?', [Chan()],
+            "Returns if frequency-shift keying modulation is enabled or not", to_bool),
+    Command('set_fsk_source', 'SOURCE{chan}:FSK:SOUR {src}', [Enum('src', 'INT', ('INT','EXT')), Chan()],
+            "Sets FSK source to INTernal or EXTernal"),
+    Command('get_fsk_source', 'SOURCE{chan}:FSK:SOUR?', [Chan()],
+            "Returns current FSK source"),
+    Command('set_fsk_frequency', 'SOURCE{chan}:FSK:FREQ {freq}', [Number('freq', 100, frequency_limits), Chan()],
+            "Sets FSK function frequenc. Can be number or MIN or MAX"),
+    Command('get_fsk_frequency', 'SOURCE{chan}:FSK:FREQ?', [Chan()],
+            "Returns current internal FSK function frequency", to_float),
+    Command('set_fsk_internal_rate', 'SOURCE{chan}:FSK:INT:RATE {rate}', [Number('rate', 100, (2e-3, 100e3)), Chan()],
+            "Sets FSK rate for internal sources. Can be number or MIN or MAX"),
+    Command('get_fsk_internal_rate', 'SOURCE{chan}:FSK:INT:RATE?', [Chan()],
+            "Returns current FSK internal rate", to_float),
     # Frequency sweep commands
-    #####################
-    # FS state commands
-    #####################
-    def set_fs_state(self, enable=True, chan=1):
-        """Enables of disables Frequency sweep"""
-        return self.msg('SOURCE'+str(chan)+':SWE:STATE '+str("ON" if enable else "OFF"))
-    
-    def get_fs_state(self, chan=1):
-        """Returns if Frequency sweep is enabled or not"""
-        return self.msg('SOURCE'+str(chan)+':SWE:STATE?')
-    
-    # FS start commands
-    #####################
-    def set_fs_start(self, freq=1, chan=1):
-        """Sets start frequency of FS. Can be number, 'MIN' or 'MAX'"""
-        return self.msg('SOURCE'+str(chan)+':FREQ:STAR '+str(freq))
-    
-    def get_fs_start(self, chan=1):
-        """Returns FS start frequency"""
-        return self.msg('SOURCE'+str(chan)+':FREQ:STAR?')
-    
-    # FS stop commands
-    #####################
-    def set_fs_stop(self, freq=1, chan=1):
-        """Sets stop frequency of FS. Can be number, 'MIN' or 'MAX'"""
-        return self.msg('SOURCE'+str(chan)+':FREQ:STOP '+str(freq))
-    
-    def get_fs_stop(self, chan=1):
-        """Returns FS stop frequency"""
-        return self.msg('SOURCE'+str(chan)+':FREQ:STOP?')
-    
-    # FS spacing commands
-    #####################
-    def set_fs_spacing(self, rate=1, chan=1):
-        """Sets FS sweep rate. Can be number (Hz), 'MIN' or 'MAX' """
-        return self.msg('SOURCE'+str(chan)+':SWE:RATE '+str(rate))
-    
-    def get_fs_spacing(self, chan=1):
-        """Returns FS sweep rate"""
-        return self.msg('SOURCE'+str(chan)+':SWE:RATE?')
-    
-    # FS source commands
-    #####################
-    def set_fs_source(self, src='IMM', chan=1):
-        """Sets FS source to 'IMMediate' or 'EXTernal'"""
-        if src.upper() in ['IMM','EXT']:
-            return self.msg('SOURCE'+str(chan)+':SWE:SOUR '+str(src))
-        else:
-            raise RangeException
-    
-    def get_fs_source(self, chan=1):
-        """Returns FS source"""
-        return self.msg('SOURCE'+str(chan)+':SWE:SOUR?')
-    
+    Command('set_fs_state', 'SOURCE{chan}:SWE:STATE {enable}', [Switch('enable', True), Chan()],
+            "Enables of disables Frequency sweep"),
+    Command('get_fs_state', 'SOURCE{chan}:SWE:STATE?', [Chan()],
+            "Returns if Frequency sweep is enabled or not", to_bool),
+    Command('set_fs_start', 'SOURCE{chan}:FREQ:STAR {freq}', [Number('freq', 1, frequency_limits), Chan()],
+            "Sets start frequency of FS. Can be number, 'MIN' or 'MAX'"),
+    Command('get_fs_start', 'SOURCE{chan}:FREQ:STAR?', [Chan()],
+            "Returns FS start frequency", to_float),
+    Command('set_fs_stop', 'SOURCE{chan}:FREQ:STOP {freq}', [Number('freq', 1, frequency_limits), Chan()],
+            "Sets stop frequency of FS. Can be number, 'MIN' or 'MAX'"),
+    Command('get_fs_stop', 'SOURCE{chan}:FREQ:STOP?', [Chan()],
+            "Returns FS stop frequency", to_float),
+    Command('set_fs_spacing', 'SOURCE{chan}:SWE:RATE {rate}', [Number('rate', 1), Chan()],
+            "Sets FS sweep rate. Can be number (Hz), 'MIN' or 'MAX' "),
+    Command('get_fs_spacing', 'SOURCE{chan}:SWE:RATE?', [Chan()],
+            "Returns FS sweep rate", to_float),
+    Command('set_fs_source', 'SOURCE{chan}:SWE:SOUR {src}', [Enum('src', 'IMM', ('IMM','EXT')), Chan()],
+            "Sets FS source to 'IMMediate' or 'EXTernal'"),
+    Command('get_fs_source', 'SOURCE{chan}:SWE:SOUR?', [Chan()],
+            "Returns FS source"),
     # Frequency counter commands
-    #####################
-    # FC gate commands
-    #####################
-    def set_fc_gate(self, gate=0.1):
-        """Sets frequency counter gate time"""
-        return self.msg('COUN:GAT '+str(gate))
-    
-    def get_fc_gate(self):
-        """Returns current frequency counter gate time"""
-        return self.msg('COUN:GAT?')
-    
-    # FC state commands
-    #####################
-    def set_fc_state(self, enable=True):
-        """Enables / disables frequency counter"""
-        return self.msg('COUN:STAT '+str("ON" if enable else "OFF"))
-    
-    def get_fc_state(self):
-        """Returns if frequency counter is enabled"""
-        return self.msg('COUN:STAT?')
-    
-    # FC counts commands
-    #####################
-    def get_fc_value(self):
-        """Returns counter frequency"""
-        return self.msg('COUN:VAL?')
+    Command('set_fc_gate', 'COUN:GAT {gate}', [Number('gate', 0.1, (0.01, 10))],
+            "Sets frequency counter gate time"),
+    Command('get_fc_gate', 'COUN:GAT?', [],
+            "Returns current frequency counter gate time", to_float),
+    Command('set_fc_state', 'COUN:STAT {enable}', [Switch('enable', True)],
+            "Enables / disables frequency counter"),
+    Command('get_fc_state', 'COUN:STAT?', [],
+            "Returns if frequency counter is enabled", to_bool),
+    Command('get_fc_value', 'COUN:VAL?', [],
+            "Returns counter frequency", to_float),
+]
+
+install(AFGbase, basecommands)
+install(AFG2100, modulationcommands)
 
 class AFG2005(AFG2000):
     def __init__(self,dev):
@@ -596,7 +1687,7 @@ class AFG2105(AFG2100):
 class AFG2012(AFG2000):
     def __init__(self,dev):
         super().__init__(dev)
-        self.frequencyrange["Sine"]=(0.1,1*10**6)
+        self.frequencyrange["Sine"]=(0.1,12*10**6)
         self.frequencyrange["Square"]=(0.1,12*10**6)
         
     def info(self):
@@ -629,3 +1720,399 @@ class AFG2125(AFG2100):
     def info(self):
         return("AFG2125")
 
+
+models={
+    "AFG-2005": AFG2005,
+    "AFG-2105": AFG2105,
+    "AFG-2012": AFG2012,
+    "AFG-2112": AFG2112,
+    "AFG-2025": AFG2025,
+    "AFG-2125": AFG2125,
+}
+
+
+class AsyncAFG(AFGbase):
+    """asyncio counterpart of AFGbase.
+    Offers the same command methods, but each returns an awaitable and the command is written
+    immediately, so many commands on many devices can be outstanding at once.
+    Replies are read from the event loop (loop.add_reader on the port), no threads are used.
+    Must be created while the event loop is running; use 'await AsyncAFG.open(dev)'
+    to get the class matching the connected model"""
+    
+    @classmethod
+    async def open(cls, dev):
+        """Identifies the device at 'dev' and returns it opened as matching Async model class"""
+        probe=AsyncAFG(dev)
+        info=await probe.identify()
+        for model, modelcls in asyncmodels.items():
+            if info is not None and model in info:
+                probe.loop.remove_reader(probe.fd)
+                return modelcls(probe.ser)
+        probe.closecon()
+        raise DeviceException
+    
+    def opencon(self,dev):
+        """Opens 'dev' (see open_transport), or takes over 'dev' if it is an already open connection.
+        The connection must have a file descriptor"""
+        # asyncio is imported here, it is slow to import and not needed by the threaded classes
+        import asyncio
+        self.loop=asyncio.get_running_loop()
+        self.ser = open_transport(dev, timeout=0)
+        self.fd=self.ser.fileno()
+        self.pending=collections.deque()
+        self.lock=threading.Lock()
+        self.linebuf=bytearray()
+        self.writebuf=bytearray()
+        self.drained=None
+        self.loop.add_reader(self.fd, self.on_readable)
+    
+    def closecon(self):
+        """Unregisters the port from the event loop and closes it.
+        Queries still waiting for a reply return None"""
+        self.flush_coalesced()
+        self.loop.remove_reader(self.fd)
+        self.loop.remove_writer(self.fd)
+        self.ser.close()
+        while self.pending:
+            fut=self.pending.popleft()
+            if not fut.done():
+                fut.set_result(None)
+    
+    def on_readable(self):
+        try:
+            data=os.read(self.fd, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        self.feed(data)
+    
+    def on_writable(self):
+        try:
+            n=os.write(self.fd, self.writebuf)
+        except (BlockingIOError, InterruptedError):
+            return
+        del self.writebuf[:n]
+        if not self.writebuf:
+            self.loop.remove_writer(self.fd)
+            if self.drained is not None and not self.drained.done():
+                self.drained.set_result(None)
+    
+    def write(self, data):
+        """Writes bytes without blocking, what the port does not take now is sent from the event loop"""
+        if not self.writebuf:
+            try:
+                data=memoryview(data)[os.write(self.fd, data):]
+            except (BlockingIOError, InterruptedError):
+                pass
+            if not data:
+                return
+            self.loop.add_writer(self.fd, self.on_writable)
+        self.writebuf+=data
+    
+    async def drain(self):
+        """Waits until all written data was handed to the port"""
+        if self.writebuf:
+            if self.drained is None or self.drained.done():
+                self.drained=self.loop.create_future()
+            await self.drained
+    
+    def route_reply(self, reply):
+        if not self.pending:
+            self.strays+=1
+            return
+        if self.pending[0] is self.marker and not self.identifies(reply):
+            # late replies in front of the resync handshake
+            self.late+=1
+            return
+        fut=self.pending.popleft()
+        if not fut.done():
+            fut.set_result(reply)
+    
+    def transmit(self, data, fut=None):
+        if fut is not None:
+            fut.sent=time.perf_counter()
+            self.pending.append(fut)
+        self.write(data)
+    
+    async def wait_reply(self, fut, msg=None):
+        """Waits for the reply routed to 'fut' of query 'msg', None if it does not arrive in time.
+        Timeouts, resync and retries as in AFGbase.wait_reply()"""
+        import asyncio
+        for attempt in range(self.retries+1):
+            try:
+                value=await asyncio.wait_for(asyncio.shield(fut), self.timeouts.timeout(msg or '', self.replytimeout))
+            except asyncio.TimeoutError:
+                if fut in self.pending:
+                    self.pending.remove(fut)
+                self.timedout+=1
+                handshake=await self.resync()
+                self.timeouts.backoff(msg or '', self.replytimeout, handshake or 0.0)
+                if handshake is None or msg is None or not self.idempotent(msg) or attempt == self.retries:
+                    fut.cancel()
+                    return None
+                self.transmit((msg+'\r').encode('ascii'), fut)
+                continue
+            if msg is not None:
+                self.timeouts.learn(msg, time.perf_counter()-fut.sent)
+            return value
+    
+    async def resync(self):
+        """See AFGbase.resync()"""
+        import asyncio
+        t0=time.perf_counter()
+        if self.marker is not None:
+            # another query already resynchronizes
+            try:
+                await asyncio.wait_for(asyncio.shield(self.marker), self.timeouts.maximum)
+                return time.perf_counter()-t0
+            except asyncio.TimeoutError:
+                return None
+        marker=self.new_future()
+        stale=list(self.pending)
+        self.pending.clear()
+        self.linebuf.clear()
+        if hasattr(self.ser, 'reset_input_buffer'):
+            self.ser.reset_input_buffer()
+        self.marker=marker
+        self.pending.append(marker)
+        self.write(b'*IDN?\r')
+        self.resyncs+=1
+        for fut in stale:
+            if not fut.done():
+                fut.set_result(None)
+        try:
+            await asyncio.wait_for(asyncio.shield(marker), self.timeouts.maximum)
+            return time.perf_counter()-t0
+        except asyncio.TimeoutError:
+            if marker in self.pending:
+                self.pending.remove(marker)
+            return None
+        finally:
+            self.marker=None
+    
+    def new_future(self):
+        return self.loop.create_future()
+    
+    def call_later(self, delay, func):
+        self.loop.call_later(delay, func)
+    
+    def typed(self, result, convert):
+        """Returns a Task resolving to the awaited 'result' converted by convert()"""
+        if convert is None:
+            return result
+        async def typed():
+            value=await result
+            return None if value is None else convert(value)
+        return self.loop.create_task(typed())
+    
+    def result(self, value):
+        return self.deferred(value)
+    
+    def flush_batch(self, cmds):
+        """Writes (msg, fut) pairs as ';'-joined lines, the Futures of the queries are resolved
+        from the event loop when the replies arrive"""
+        for line, futs in self.batch_lines(cmds):
+            linefut=self.new_future() if futs else None
+            self.send(line, linefut)
+            if linefut is not None:
+                self.loop.create_task(self.resolve_line(linefut, line, futs))
+    
+    async def resolve_line(self, linefut, line, futs):
+        self.split_reply(await self.wait_reply(linefut, line), futs)
+    
+    async def sync(self):
+        """Fence, see AFGbase.sync()"""
+        import asyncio
+        if self.capturecmds is not None:
+            return
+        self.flush_coalesced()
+        if self.batchcmds:
+            cmds, self.batchcmds = self.batchcmds, []
+            self.flush_batch(cmds)
+        commands=self.window_commands()
+        errors=[]
+        first=True
+        while True:
+            futs=self.fence_round(first)
+            await asyncio.wait(futs)
+            replies=[None if fut.cancelled() else fut.result() for fut in futs]
+            if first and replies.pop(0) is None:
+                errors.append((None, 'No reply to *OPC?'))
+            first=False
+            if not self.collect_errors(replies, errors):
+                break
+        self.window.clear()
+        if errors:
+            raise CommandError(errors, commands)
+    
+    @contextlib.asynccontextmanager
+    async def fence(self):
+        """Runs sync() when the 'async with' block exits without exception"""
+        self.window.clear()
+        yield self
+        await self.sync()
+    
+    async def set_aw_dac(self, block="-511, -206, 0, 206, 511, 206, 0, -206", start=0, progress=None, chunksize=256):
+        """Loads 'block' into memory, starting at point 'start'. See AFGbase.set_aw_dac.
+        The upload is written from the event loop, other devices keep running meanwhile"""
+        if isinstance(block, str):
+            return await self.msg('DATA:DAC VOLATILE, '+str(start)+', '+block)
+        data=dac_block(block, self.dacrange, self.dacbyteorder)
+        if self.capturecmds is not None:
+            self.capture_dac(data, start)
+            return None
+        self.flush_coalesced()
+        if self.batchcmds:
+            cmds, self.batchcmds = self.batchcmds, []
+            self.flush_batch(cmds)
+        total=len(data)
+        header=('DATA:DAC VOLATILE, '+str(start)+', ').encode('ascii')+block_header(total)
+        done=self.observe('DATA:DAC', len(header)+total+1) if self.observing else None
+        self.window.append('DATA:DAC VOLATILE, '+str(start)+', <'+str(total)+' bytes>')
+        self.timeouts.sent('DATA:DAC')
+        t0=time.monotonic()
+        self.write(header)
+        rate=0
+        for sent in range(0, total, chunksize):
+            self.write(data[sent:sent+chunksize])
+            await self.drain()
+            rate=min(sent+chunksize, total)/max(time.monotonic()-t0, 1e-9)
+            if progress is not None:
+                progress(min(sent+chunksize, total), total, rate)
+        self.write(b'\r')
+        await self.drain()
+        if done is not None:
+            done(None)
+        return rate
+
+class AsyncAFG2005(AsyncAFG, AFG2005):
+    pass
+
+class AsyncAFG2105(AsyncAFG, AFG2105):
+    pass
+
+class AsyncAFG2012(AsyncAFG, AFG2012):
+    pass
+
+class AsyncAFG2112(AsyncAFG, AFG2112):
+    pass
+
+class AsyncAFG2025(AsyncAFG, AFG2025):
+    pass
+
+class AsyncAFG2125(AsyncAFG, AFG2125):
+    pass
+
+asyncmodels={
+    "AFG-2005": AsyncAFG2005,
+    "AFG-2105": AsyncAFG2105,
+    "AFG-2012": AsyncAFG2012,
+    "AFG-2112": AsyncAFG2112,
+    "AFG-2025": AsyncAFG2025,
+    "AFG-2125": AsyncAFG2125,
+}
+
+
+# Command line
+###################
+def recipe_lines(recipe, repeat):
+    """Yields (pass, line number, command) for the commands of 'recipe' (file name, '-' for stdin), 'repeat' times
+    (0: forever). Blank lines and lines starting with '#' are skipped. Files are read again for every pass,
+    stdin is only kept in memory if it has to be repeated"""
+    def read():
+        if recipe != '-':
+            with open(recipe) as f:
+                yield from f
+        elif cached is not None:
+            yield from cached
+        else:
+            yield from sys.stdin
+    cached=None
+    if recipe == '-' and repeat != 1:
+        cached=sys.stdin.readlines()
+    n=0
+    while repeat == 0 or n < repeat:
+        for lineno, line in enumerate(read(), 1):
+            line=line.strip()
+            if line and not line.startswith('#'):
+                yield n, lineno, line
+        n+=1
+
+def main(argv=None):
+    """python -m arbitrage DEVICE [RECIPE]: streams the SCPI commands of RECIPE (default stdin)
+    to DEVICE, one per line. Set commands are written without waiting for the device, queries are
+    pipelined behind them and their replies are written in recipe order as CSV or JSON lines
+    with the time they arrived. Ends with a fence, device errors are reported and exit with status 1"""
+    import argparse
+    parser=argparse.ArgumentParser(prog='python -m arbitrage',
+                                   description='Streams SCPI commands from a recipe file or stdin to an instrument.')
+    parser.add_argument('device', help='port name or URL, e.g. /dev/ttyACM0 or sim://AFG-2105')
+    parser.add_argument('recipe', nargs='?', default='-', help='one command per line, - for stdin (default)')
+    parser.add_argument('-o', '--output', default='-', help='file for the query results, - for stdout (default)')
+    parser.add_argument('-f', '--format', choices=('csv', 'jsonl'), default='csv', help='result format (default csv)')
+    parser.add_argument('-n', '--repeat', type=int, default=1, help='runs the recipe N times, 0 forever (default 1)')
+    parser.add_argument('-r', '--rate', type=float, help='sends at most RATE commands per second')
+    parser.add_argument('-w', '--window', type=int, default=32, help='queries awaiting a reply at most (default 32)')
+    parser.add_argument('-t', '--timeout', type=float, help='seconds to wait for a reply until the reply times are learned (default 1)')
+    parser.add_argument('--no-sync', action='store_true', help='skip the final fence and error check')
+    args=parser.parse_args(argv)
+
+    out=sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+    if args.format == 'csv':
+        import csv
+        writer=csv.writer(out)
+        writer.writerow(('time', 'pass', 'line', 'command', 'reply'))
+        def emit(t, n, lineno, cmd, reply):
+            writer.writerow(('%.6f' % t, n, lineno, cmd, '' if reply is None else reply))
+    else:
+        def emit(t, n, lineno, cmd, reply):
+            out.write(json.dumps({'time': t, 'pass': n, 'line': lineno, 'command': cmd, 'reply': reply})+'\n')
+
+    gen=AFGbase(args.device)
+    if args.timeout is not None:
+        gen.replytimeout=args.timeout
+    # queries in flight as [future, pass, line number, command, arrival time]
+    inflight=collections.deque()
+    def arrived(entry):
+        return lambda fut: entry.__setitem__(4, time.time())
+    def collect(full):
+        """Writes the results of the answered queries in recipe order,
+        waits for replies while more than 'full' queries are in flight"""
+        while inflight and (inflight[0][0].done() or len(inflight) > full):
+            entry=inflight.popleft()
+            reply=gen.wait_reply(entry[0], entry[3])
+            emit(entry[4] or time.time(), *entry[1:4], reply)
+        out.flush()
+    status=0
+    try:
+        t0=time.monotonic()
+        for count, (n, lineno, cmd) in enumerate(recipe_lines(args.recipe, args.repeat)):
+            if args.rate:
+                wait=t0+count/args.rate-time.monotonic()
+                if wait > 0:
+                    collect(args.window)
+                    time.sleep(wait)
+            if is_query(cmd):
+                entry=[gen.new_future(), n, lineno, cmd, None]
+                entry[0].add_done_callback(arrived(entry))
+                inflight.append(entry)
+                gen.send(cmd, entry[0])
+            else:
+                gen.send(cmd)
+            collect(args.window)
+        collect(0)
+        if not args.no_sync:
+            try:
+                gen.sync()
+            except CommandError as e:
+                sys.stderr.write(str(e)+'\n')
+                status=1
+    except KeyboardInterrupt:
+        status=130
+    finally:
+        gen.closecon()
+        if out is not sys.stdout:
+            out.close()
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
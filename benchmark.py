@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""Driver benchmarks against a simulated instrument, a pty-backed fake serial port or real hardware.
+
+    python benchmark.py                          # in-process simulator, no link model
+    python benchmark.py --target pty --baudrate 9600 --latency 0.001
+    python benchmark.py --target /dev/ttyACM0 --output afg2105.json
+
+Results are printed and written as JSON (default benchmark.json) for comparison between versions"""
+
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import time
+
+import arbitrage
+import simulator
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    """Returns min, the given percentiles, max and mean of 'samples' in seconds"""
+    s=sorted(samples)
+    result={'min': s[0]}
+    for p in points:
+        result['p'+str(p)]=s[min(len(s)-1, int(round(p/100*(len(s)-1))))]
+    result['max']=s[-1]
+    result['mean']=sum(s)/len(s)
+    return result
+
+
+def sync(gen):
+    """Waits until the device processed everything sent so far"""
+    gen.msg('*OPC?')
+
+
+def bench_latency(gen, n):
+    """Round trip time of set and query commands"""
+    sets, queries = [], []
+    for i in range(n):
+        t=time.perf_counter()
+        gen.set_freq(1000+i)
+        sets.append(time.perf_counter()-t)
+        t=time.perf_counter()
+        gen.get_freq()
+        queries.append(time.perf_counter()-t)
+    return {'set': percentiles(sets), 'query': percentiles(queries)}
+
+
+def bench_throughput(gen, n):
+    """Sustained set_freq commands per second, plain and batched, until the device has processed them"""
+    sync(gen)
+    t=time.perf_counter()
+    for i in range(n):
+        gen.set_freq(1000+i)
+    sync(gen)
+    plain=n/(time.perf_counter()-t)
+    t=time.perf_counter()
+    with gen.batch():
+        for i in range(n):
+            gen.set_freq(1000+i)
+    sync(gen)
+    batched=n/(time.perf_counter()-t)
+    return {'commands_per_second': plain, 'batched_commands_per_second': batched}
+
+
+def bench_apply(gen, n):
+    """Time to apply a function and have it processed"""
+    times=[]
+    for i in range(n):
+        t=time.perf_counter()
+        gen.apply_func(func='SIN', freq=1000+i, amp=1, off=0)
+        sync(gen)
+        times.append(time.perf_counter()-t)
+    return percentiles(times)
+
+
+def bench_upload(gen, sizes):
+    """set_aw_dac upload rate for binary blocks and comma separated text"""
+    results={}
+    for size in sizes:
+        samples=[(i*37)%1023-511 for i in range(size)]
+        text=', '.join(str(v) for v in samples)
+        t=time.perf_counter()
+        gen.set_aw_dac(samples)
+        sync(gen)
+        binary=time.perf_counter()-t
+        t=time.perf_counter()
+        gen.set_aw_dac(text)
+        sync(gen)
+        textual=time.perf_counter()-t
+        results[str(size)]={'binary_seconds': binary, 'binary_bytes_per_second': 2*size/binary,
+                            'ascii_seconds': textual, 'ascii_bytes_per_second': len(text)/textual}
+    return results
+
+
+def open_target(target, model, baudrate, latency):
+    if target in ('sim', 'pty'):
+        device=simulator.SimulatedAFG(model, baudrate=baudrate, latency=latency)
+        if target == 'sim':
+            return arbitrage.Arbitrage(simulator.SimulatedTransport(device)).device
+        return arbitrage.Arbitrage(simulator.serve_pty(device)).device
+    return arbitrage.Arbitrage(target).device
+
+
+def revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=sys.path[0] or '.').stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--target', default='sim', help="'sim', 'pty' or a port name/URL of a real device")
+    parser.add_argument('--model', default='AFG-2105', help='simulated model')
+    parser.add_argument('--baudrate', type=float, default=None, help='simulated link speed (default: unlimited)')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated processing time per command in s')
+    parser.add_argument('-n', type=int, default=200, help='iterations per measurement')
+    parser.add_argument('--sizes', default='256,1024,4096', help='waveform sizes for the upload benchmark')
+    parser.add_argument('--output', default='benchmark.json', help="result file, '-' for stdout only")
+    args=parser.parse_args(argv)
+
+    gen=open_target(args.target, args.model, args.baudrate, args.latency)
+    results={
+        'meta': {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'revision': revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'target': args.target,
+            'model': args.model,
+            'baudrate': args.baudrate,
+            'latency': args.latency,
+            'n': args.n,
+        },
+    }
+    try:
+        results['latency']=bench_latency(gen, args.n)
+        results['throughput']=bench_throughput(gen, args.n)
+        results['apply_func']=bench_apply(gen, max(1, args.n//10))
+        results['upload']=bench_upload(gen, [int(s) for s in args.sizes.split(',')])
+    finally:
+        gen.closecon()
+
+    text=json.dumps(results, indent=2)
+    print(text)
+    if args.output != '-':
+        with open(args.output, 'w') as f:
+            f.write(text+'\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import math
+import threading
+import time
+import numpy as np
+
+
+class CounterStream():
+    """Background acquisition of the frequency counter of an AFG-21xx.
+    The counter is polled once per gate time on a fixed monotonic schedule. Readings are stored
+    with their timestamps (seconds since the epoch) in a preallocated ring buffer of 'size' entries,
+    so memory use does not grow however long it runs.
+    Mean, standard deviation and Allan deviation (at tau = gate time) are updated with every reading
+    and cover the whole run, not only the buffered part"""
+    def __init__(self, gen, gate=0.1, size=100000):
+        self.gen=gen
+        self.gate=gate
+        self.size=size
+        self.times=np.zeros(size)
+        self.values=np.zeros(size)
+        self.count=0
+        self.gaps=0
+        self.late=0
+        self.n=0
+        self.mean=0.0
+        self.m2=0.0
+        self.last=None
+        self.diffsq=0.0
+        self.ndiff=0
+        self.cond=threading.Condition()
+        self.stopped=threading.Event()
+        self.thread=None
+
+    def start(self):
+        """Sets the gate time, enables the counter and starts polling, unless it is already running. Returns self"""
+        if self.thread is not None and self.thread.is_alive():
+            return self
+        self.gen.set_fc_gate(self.gate)
+        self.gen.set_fc_state(True)
+        self.stopped.clear()
+        self.thread=threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, disable=True):
+        """Stops polling and, with 'disable', switches the counter off"""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        with self.cond:
+            self.cond.notify_all()
+        if disable:
+            self.gen.set_fc_state(False)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def run(self):
+        # wall clock timestamps are derived from the monotonic clock so they do not jump
+        mono0=time.monotonic()
+        wall0=time.time()
+        deadline=mono0
+        while not self.stopped.is_set():
+            try:
+                value=float(self.gen.get_fc_value())
+            except (TypeError, ValueError):
+                # no reply, or one that is no reading
+                value=None
+            now=time.monotonic()
+            if value is None:
+                self.gaps+=1
+            else:
+                self.add(wall0+now-mono0, value)
+            deadline+=self.gate
+            if deadline < now:
+                # fell behind: continue on the schedule instead of polling in a burst
+                skipped=math.ceil((now-deadline)/self.gate)
+                self.late+=skipped
+                deadline+=skipped*self.gate
+            self.stopped.wait(deadline-now)
+
+    def add(self, timestamp, value):
+        """Stores one reading and updates the running statistics"""
+        with self.cond:
+            i=self.count%self.size
+            self.times[i]=timestamp
+            self.values[i]=value
+            self.count+=1
+            # Welford's algorithm for mean and variance
+            self.n+=1
+            delta=value-self.mean
+            self.mean+=delta/self.n
+            self.m2+=delta*(value-self.mean)
+            if self.last is not None:
+                self.diffsq+=(value-self.last)**2
+                self.ndiff+=1
+            self.last=value
+            self.cond.notify_all()
+
+    def stddev(self):
+        """Standard deviation of all readings in Hz, None with less than two"""
+        with self.cond:
+            return math.sqrt(self.m2/(self.n-1)) if self.n > 1 else None
+
+    def allan_deviation(self, m=None):
+        """Allan deviation of the fractional frequency. Without 'm' at tau = gate time over all readings,
+        otherwise at tau = m gate times from the buffered readings (non-overlapping).
+        Gaps are not accounted for. None if there are too few readings"""
+        if m is None:
+            with self.cond:
+                if not self.ndiff or not self.mean:
+                    return None
+                return math.sqrt(self.diffsq/self.ndiff/2)/abs(self.mean)
+        times, values = self.data()
+        k=len(values)//m
+        if k < 2:
+            return None
+        averages=values[:k*m].reshape(k, m).mean(axis=1)
+        return math.sqrt(np.mean(np.diff(averages)**2)/2)/abs(averages.mean())
+
+    def statistics(self):
+        """Returns a dict with the reading count, gaps, late polls, mean, stddev and Allan deviation"""
+        return {'count': self.count, 'gaps': self.gaps, 'late': self.late, 'mean': self.mean if self.n else None,
+                'stddev': self.stddev(), 'allan_deviation': self.allan_deviation()}
+
+    def data(self):
+        """Returns copies of the buffered timestamps and readings, oldest first"""
+        with self.cond:
+            if self.count <= self.size:
+                return self.times[:self.count].copy(), self.values[:self.count].copy()
+            i=self.count%self.size
+            return np.roll(self.times, -i), np.roll(self.values, -i)
+
+    def __iter__(self):
+        """Yields (timestamp, value) for every reading from now on until stop().
+        A consumer that falls more than 'size' readings behind continues with the oldest buffered one"""
+        with self.cond:
+            pos=self.count
+        while True:
+            with self.cond:
+                while pos == self.count and not self.stopped.is_set():
+                    self.cond.wait()
+                if pos == self.count:
+                    return
+                pos=max(pos, self.count-self.size)
+                i=pos%self.size
+                item=(float(self.times[i]), float(self.values[i]))
+            pos+=1
+            yield item
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Group():
+    """Several AFGbase instances driven as one, each from its own thread, so a command
+    to all members takes about as long as to one.
+    Any command method called on the group runs on all members concurrently and returns
+    the list of their results, e.g. group.set_freq(1000)"""
+    def __init__(self, gens):
+        self.gens=list(gens)
+        self.executor=ThreadPoolExecutor(max(1, len(self.gens)))
+
+    def __len__(self):
+        return len(self.gens)
+
+    def map(self, func):
+        """Runs func(gen) for all members concurrently, returns the results in member order.
+        Exceptions are raised after all members finished"""
+        return [fut.result() for fut in [self.executor.submit(func, gen) for gen in self.gens]]
+
+    def __getattr__(self, name):
+        if name.startswith('__') or not self.gens or not hasattr(self.gens[0], name):
+            raise AttributeError(name)
+        def method(*args, **kwargs):
+            return self.map(lambda gen: getattr(gen, name)(*args, **kwargs))
+        method.__name__=name
+        return method
+
+    def encode(self, setup):
+        """Returns per member (msg, data) lines of the commands setup(gen) issues.
+        The commands are captured for every member, so setup may depend on it. Members of a model class
+        that issue the same commands share their encoding"""
+        encoded=dict()
+        result=[]
+        for gen in self.gens:
+            with gen.capture() as cmds:
+                setup(gen)
+            key=(type(gen), gen.inputbuffer, tuple(cmds))
+            if key not in encoded:
+                lines=[line for line, futs in gen.batch_lines((msg, None) for msg in cmds)]
+                encoded[key]=list(zip(lines, gen.encode_lines(cmds)))
+            result.append(encoded[key])
+        return result
+
+    def configure(self, setup, enable=True, lead=0.001):
+        """Sends the configuration setup(gen) issues (e.g. lambda gen: gen.apply_sine(1000, 1)) to all members,
+        waits until every member has processed it without errors (sync(), raises CommandError),
+        then switches the outputs on together ('enable'). Configuration and enable are encoded beforehand.
+        The enable commands are released 'lead' seconds after the last member reached the barrier.
+        Returns a report with per member 'written' (enable write finished) and 'confirmed' (*OPC? answered)
+        times in seconds after the release, and their spread as 'skew' and 'confirm_skew'"""
+        config=self.encode(setup)
+        outputs=self.encode(lambda gen: gen.set_output_enabled(True)) if enable else [[] for gen in self.gens]
+        release=[None]
+        def start():
+            release[0]=time.perf_counter()+lead
+        barrier=threading.Barrier(len(self.gens), action=start)
+        def run(i):
+            gen=self.gens[i]
+            flush=getattr(gen.ser, 'flush', None)
+            try:
+                gen.window.clear()
+                for msg, data in config[i]:
+                    gen.send(msg, data=data)
+                gen.sync()
+            except BaseException:
+                barrier.abort()
+                raise
+            barrier.wait()
+            while time.perf_counter() < release[0]:
+                pass
+            for msg, data in outputs[i]:
+                gen.send(msg, data=data)
+            if flush is not None:
+                flush()
+            written=time.perf_counter()-release[0]
+            gen.msg('*OPC?')
+            return written, time.perf_counter()-release[0]
+        futs=[self.executor.submit(run, i) for i in range(len(self.gens))]
+        errors=[fut.exception() for fut in futs]
+        for e in errors:
+            # the first real error, not the BrokenBarrierError it caused in the other members
+            if e is not None and not isinstance(e, threading.BrokenBarrierError):
+                raise e
+        for e in errors:
+            if e is not None:
+                raise e
+        for gen in self.gens:
+            gen.invalidate_shadow_state()
+        written=[fut.result()[0] for fut in futs]
+        confirmed=[fut.result()[1] for fut in futs]
+        return {
+            'written': written,
+            'confirmed': confirmed,
+            'skew': max(written)-min(written),
+            'confirm_skew': max(confirmed)-min(confirmed),
+        }
+
+    def closecon(self):
+        self.map(lambda gen: gen.closecon())
+        self.executor.shutdown()
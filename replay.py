@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""Records the traffic of a session and replays it without the instrument.
+
+    python replay.py session.arblog          # prints the recorded traffic
+
+Recording: open the instrument with record(dev, path) as transport, e.g.
+    arbitrage.Arbitrage(replay.record('/dev/ttyACM0', 'session.arblog'))
+Replaying: run the same code on 'replay://session.arblog' (recorded timing) or
+'replay://session.arblog?speed=0' (as fast as possible), then check the transport's 'mismatches'.
+Only the threaded AFGbase classes are supported, AsyncAFG does its I/O on the file descriptor"""
+
+import argparse
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+
+import arbitrage
+
+MAGIC=b'ARBLOG1\n'
+# kind (b'W' written, b'R' read), seconds since the recording started, length of the data that follows
+RECORD=struct.Struct('<cdI')
+
+
+def read_log(path):
+    """Returns the records of log 'path' as a list of (kind, seconds, data)"""
+    with open(path, 'rb') as f:
+        buf=f.read()
+    if not buf.startswith(MAGIC):
+        raise ValueError(path+' is not a session log')
+    records=[]
+    pos=len(MAGIC)
+    while pos+RECORD.size <= len(buf):
+        kind, t, n = RECORD.unpack_from(buf, pos)
+        pos+=RECORD.size
+        records.append((kind, t, buf[pos:pos+n]))
+        pos+=n
+    return records
+
+
+class RecordingTransport():
+    """Wraps transport 'ser' and logs every write and every non-empty read with its monotonic time to 'path'"""
+    def __init__(self, ser, path):
+        self.ser=ser
+        self.log=open(path, 'wb')
+        self.log.write(MAGIC)
+        self.lock=threading.Lock()
+        self.t0=time.monotonic()
+        # reads arrive in small pieces, consecutive ones are stored as one record
+        self.reading=None
+
+    def record(self, kind, data):
+        with self.lock:
+            if self.log.closed:
+                return
+            if kind == b'R':
+                if self.reading is None:
+                    self.reading=(time.monotonic()-self.t0, bytearray())
+                self.reading[1].extend(data)
+                return
+            self.flush_reading()
+            self.log.write(RECORD.pack(kind, time.monotonic()-self.t0, len(data)))
+            self.log.write(data)
+
+    def flush_reading(self):
+        if self.reading is not None:
+            t, data = self.reading
+            self.log.write(RECORD.pack(b'R', t, len(data)))
+            self.log.write(data)
+            self.reading=None
+
+    @property
+    def timeout(self):
+        return self.ser.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.ser.timeout=value
+
+    def __getattr__(self, name):
+        # in_waiting, flush, cancel_read, fileno, ... of the wrapped transport
+        return getattr(self.ser, name)
+
+    def write(self, data):
+        self.record(b'W', bytes(data))
+        return self.ser.write(data)
+
+    def read(self, size=1):
+        data=self.ser.read(size)
+        if data:
+            self.record(b'R', data)
+        return data
+
+    def close(self):
+        self.ser.close()
+        with self.lock:
+            self.flush_reading()
+            self.log.close()
+
+
+def record(dev, path, timeout=None):
+    """Opens 'dev' (see arbitrage.open_transport) and records its traffic to 'path'"""
+    return RecordingTransport(arbitrage.open_transport(dev, timeout), path)
+
+
+class ReplayTransport():
+    """Transport that answers from a session log instead of an instrument.
+    A recorded reply is released once everything written before it in the recording has been written again,
+    with 'speed' 1 after the same delay as recorded (2 twice as fast), with 0 immediately.
+    Writes that differ from the recording are collected in 'mismatches' as (offset, expected, written)"""
+    def __init__(self, path, speed=1.0, timeout=None):
+        self.timeout=timeout
+        self.speed=speed
+        self.is_open=True
+        self.cond=threading.Condition()
+        self.cancelled=False
+        self.expected=bytearray()
+        # replies as (bytes written before it, seconds after the last of those writes, data)
+        self.replies=[]
+        last=0.0
+        for kind, t, data in read_log(path):
+            if kind == b'W':
+                self.expected+=data
+                last=t
+            else:
+                self.replies.append((len(self.expected), t-last, data))
+        self.written=0
+        self.writetimes=[(0, time.monotonic())]
+        self.next=0
+        self.rx=bytearray()
+        self.mismatches=[]
+
+    def write(self, data):
+        data=bytes(data)
+        with self.cond:
+            expected=bytes(self.expected[self.written:self.written+len(data)])
+            if expected != data:
+                self.mismatches.append((self.written, expected, data))
+            self.written+=len(data)
+            self.writetimes.append((self.written, time.monotonic()))
+            self.cond.notify_all()
+        return len(data)
+
+    def due(self):
+        """Moves the replies whose time has come to the receive buffer, returns the time until the next one"""
+        now=time.monotonic()
+        while self.next < len(self.replies):
+            needed, delay, data = self.replies[self.next]
+            if self.written < needed:
+                return None
+            if self.speed:
+                # time the write completing the bytes the reply depends on was made
+                for count, t in self.writetimes:
+                    if count >= needed:
+                        break
+                release=t+delay/self.speed
+                if release > now:
+                    return release-now
+            self.rx+=data
+            self.next+=1
+            self.writetimes=[(count, t) for count, t in self.writetimes if count >= needed]
+        return None
+
+    @property
+    def in_waiting(self):
+        with self.cond:
+            self.due()
+            return len(self.rx)
+
+    def read(self, size=1):
+        """Returns up to 'size' replayed bytes, waiting for them until 'timeout' runs out or the read is cancelled"""
+        deadline=None if self.timeout is None else time.monotonic()+self.timeout
+        with self.cond:
+            while True:
+                wait=self.due()
+                if self.rx or self.cancelled or not self.is_open:
+                    break
+                if deadline is not None:
+                    left=deadline-time.monotonic()
+                    if left <= 0:
+                        break
+                    wait=left if wait is None else min(wait, left)
+                self.cond.wait(wait)
+            self.cancelled=False
+            data=bytes(self.rx[:size])
+            del self.rx[:size]
+            return data
+
+    def flush(self):
+        pass
+
+    def cancel_read(self):
+        with self.cond:
+            self.cancelled=True
+            self.cond.notify_all()
+
+    def reset_input_buffer(self):
+        with self.cond:
+            self.rx.clear()
+
+    def close(self):
+        with self.cond:
+            self.is_open=False
+            self.cond.notify_all()
+
+    def finished(self):
+        """Returns True if everything recorded has been written and read again"""
+        with self.cond:
+            return self.written >= len(self.expected) and self.next == len(self.replies) and not self.rx
+
+
+def open_url(url, timeout=None):
+    """Returns a ReplayTransport for 'replay://<path>?speed=..'"""
+    parts=urllib.parse.urlsplit(url)
+    query=dict(urllib.parse.parse_qsl(parts.query))
+    return ReplayTransport(parts.netloc+parts.path, float(query.get('speed', 1.0)), timeout)
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('log', help='session log written by record()')
+    args=parser.parse_args(argv)
+    for kind, t, data in read_log(args.log):
+        text=data.decode('ascii', errors='replace') if len(data) <= 80 else '<'+str(len(data))+' bytes>'
+        sys.stdout.write('%12.6f %s %r\n' % (t, '>' if kind == b'W' else '<', text))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+import itertools
+import math
+import os
+import threading
+import time
+import numpy as np
+
+
+def unchanged(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+class Sweep():
+    """Software stepped sweep for any model.
+    'table' holds (time, freq, amp, offset) points, time in seconds from the sweep start.
+    None or NaN leaves a value unchanged. All commands are encoded before the sweep starts,
+    each point is written as one line on an absolute monotonic-clock schedule.
+    The write duration is learned while running and points are sent that much early,
+    so timing errors do not accumulate"""
+    def __init__(self, gen, table, chan=1, spin=0.001, late=None, skip_late=True):
+        """'spin' is the time before a deadline to stop sleeping and busy-wait instead.
+        A point is missed if it is written more than 'late' seconds (default: half the smallest step)
+        after its deadline. With 'skip_late', a missed point is dropped if the next one is already due"""
+        self.gen=gen
+        self.chan=chan
+        self.spin=spin
+        self.skip_late=skip_late
+        self.times=[]
+        self.lines=[]
+        last=(None, None, None)
+        for t, freq, amp, offset in table:
+            with gen.capture() as cmds:
+                if not unchanged(freq) and freq != last[0]:
+                    gen.set_freq(freq, chan=chan)
+                if not unchanged(amp) and amp != last[1]:
+                    gen.set_amp(amp, chan=chan)
+                if not unchanged(offset) and offset != last[2]:
+                    gen.set_offset(offset, chan=chan)
+            last=(freq if not unchanged(freq) else last[0], amp if not unchanged(amp) else last[1],
+                  offset if not unchanged(offset) else last[2])
+            self.times.append(float(t))
+            self.lines.append((';'.join(cmds), b''.join(gen.encode_lines(cmds))))
+        if late is None:
+            steps=[b-a for a, b in zip(self.times, self.times[1:]) if b > a]
+            late=min(steps)/2 if steps else 0.01
+        self.late=late
+        self.lead=0.0
+        self.stopped=threading.Event()
+
+    def stop(self):
+        """Aborts a running sweep from another thread"""
+        self.stopped.set()
+
+    def run(self, start=None):
+        """Runs the sweep, starting at monotonic time 'start' (default: now).
+        Returns a report: per point timing 'errors' (write completion minus deadline, None if skipped),
+        'sent', 'missed', 'skipped', 'mean_error', 'rms_error', 'max_error' and 'duration'"""
+        gen=self.gen
+        flush=getattr(gen.ser, 'flush', None)
+        gen.invalidate_shadow_state()
+        self.stopped.clear()
+        t0=time.monotonic() if start is None else start
+        errors=[None]*len(self.times)
+        sent=missed=skipped=0
+        for i, (t, (msg, data)) in enumerate(zip(self.times, self.lines)):
+            if self.stopped.is_set():
+                break
+            deadline=t0+t
+            now=time.monotonic()
+            if now > deadline+self.late:
+                missed+=1
+                if self.skip_late and i+1 < len(self.times) and t0+self.times[i+1] <= now:
+                    skipped+=1
+                    continue
+            else:
+                wait=deadline-self.lead-self.spin-now
+                if wait > 0:
+                    time.sleep(wait)
+                while time.monotonic() < deadline-self.lead:
+                    pass
+            if not data:
+                errors[i]=time.monotonic()-deadline
+                continue
+            before=time.monotonic()
+            gen.send(msg, data=data)
+            if flush is not None:
+                flush()
+            after=time.monotonic()
+            # learn how long a write takes so the next one is started that much early
+            self.lead=0.8*self.lead+0.2*(after-before)
+            errors[i]=after-deadline
+            sent+=1
+        gen.invalidate_shadow_state()
+        done=[e for e in errors if e is not None]
+        return {
+            'points': len(self.times),
+            'sent': sent,
+            'missed': missed,
+            'skipped': skipped,
+            'errors': errors,
+            'mean_error': sum(done)/len(done) if done else None,
+            'rms_error': math.sqrt(sum(e*e for e in done)/len(done)) if done else None,
+            'max_error': max(done, key=abs) if done else None,
+            'duration': time.monotonic()-t0,
+        }
+
+
+class Scan():
+    """Grid scan over frequency x amplitude x offset with apply_func, calling measure(freq, amp, off)
+    at every point (offset varies fastest, then amplitude).
+    All commands are encoded before the scan starts, so invalid values fail early and writing a point
+    costs a single write. Measuring overlaps with the instrument: the next point is written as soon as
+    a measurement returns, and the previous result is stored and checkpointed while it settles.
+    measure() may also return a Future (e.g. from an executor), the next point is written once it is done.
+    Results go into a structured array with the fields 'freq', 'amp', 'off', 'time' (seconds since
+    run() started), 'done' and 'fields' (default one float 'value', measure() returns a tuple
+    if there are several)"""
+    def __init__(self, gen, measure, freq, amp, off=0.0, func='SIN', chan=1, settle=0.0, verify=False,
+                 fields=(('value', float),), checkpoint=None, interval=10.0):
+        """'settle' is the time in seconds between writing a point and measuring it.
+        With 'verify' every point is confirmed with sync(), which raises CommandError on device errors.
+        With a 'checkpoint' path (.npy) the results are saved at most every 'interval' seconds and at the end,
+        run() then resumes from it: points already done are not measured again"""
+        self.gen=gen
+        self.measure=measure
+        self.settle=settle
+        self.verify=verify
+        self.checkpoint=checkpoint
+        self.interval=interval
+        self.fields=[name for name, dtype in fields]
+        grid=np.array(list(itertools.product(np.atleast_1d(freq), np.atleast_1d(amp), np.atleast_1d(off))), dtype=float)
+        self.results=np.zeros(len(grid), dtype=[('freq', float), ('amp', float), ('off', float), ('time', float),
+                                                 ('done', bool)]+list(fields))
+        self.results['freq'], self.results['amp'], self.results['off'] = grid.T
+        self.lines=[]
+        for f, a, o in grid.tolist():
+            with gen.capture() as cmds:
+                gen.apply_func(func=func, freq=f, amp=a, off=o, chan=chan)
+            self.lines.append((';'.join(cmds), b''.join(gen.encode_lines(cmds))))
+        self.stopped=threading.Event()
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self.resume(np.load(checkpoint))
+
+    def resume(self, saved):
+        """Takes over the finished points of the results 'saved' by an earlier run of the same scan"""
+        if saved.dtype != self.results.dtype or len(saved) != len(self.results):
+            raise ValueError('checkpoint does not match the scan')
+        for name in ('freq', 'amp', 'off'):
+            if not np.array_equal(saved[name], self.results[name]):
+                raise ValueError('checkpoint does not match the scan')
+        self.results=saved
+
+    def save(self):
+        tmp=self.checkpoint+'.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, self.results)
+        os.replace(tmp, self.checkpoint)
+
+    def stop(self):
+        """Aborts a running scan from another thread, finished points are kept (and checkpointed)"""
+        self.stopped.set()
+
+    def store(self, i, result):
+        if hasattr(result, 'result'):
+            result=result.result()
+        if len(self.fields) == 1:
+            result=(result,)
+        row=self.results[i]
+        for name, value in zip(self.fields, result):
+            row[name]=value
+        row['done']=True
+
+    def run(self):
+        """Runs the scan (the remaining points when resuming) and returns the results"""
+        gen=self.gen
+        flush=getattr(gen.ser, 'flush', None)
+        gen.invalidate_shadow_state()
+        self.stopped.clear()
+        t0=time.monotonic()
+        saved=t0
+        previous=None
+        try:
+            for i in np.flatnonzero(~self.results['done']):
+                if self.stopped.is_set():
+                    break
+                if previous is not None and hasattr(previous[1], 'result'):
+                    # the measurement must be over before the output changes
+                    previous=(previous[0], previous[1].result())
+                msg, data = self.lines[i]
+                gen.send(msg, data=data)
+                if flush is not None:
+                    flush()
+                written=time.monotonic()
+                # while the instrument settles: collect the previous result and checkpoint
+                if previous is not None:
+                    self.store(*previous)
+                    previous=None
+                    if self.checkpoint is not None and time.monotonic()-saved >= self.interval:
+                        self.save()
+                        saved=time.monotonic()
+                if self.verify:
+                    gen.sync()
+                wait=written+self.settle-time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                row=self.results[i]
+                row['time']=time.monotonic()-t0
+                previous=(i, self.measure(row['freq'], row['amp'], row['off']))
+            if previous is not None:
+                self.store(*previous)
+        finally:
+            gen.invalidate_shadow_state()
+            if self.checkpoint is not None:
+                self.save()
+        return self.results
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""Shares instruments between processes.
+
+    python server.py /dev/ttyACM0=/tmp/afg.sock sim://AFG-2105=localhost:5025
+
+Each DEVICE=ADDRESS opens the instrument once and serves it on a Unix socket path or TCP host:port.
+Clients use connect(address), or open 'unix://<path>' / 'socket://<host>:<port>' like any other port,
+and get the usual model class (AFG2105, ...) with all its methods"""
+
+import argparse
+import os
+import queue
+import socket
+import sys
+import threading
+
+import arbitrage
+import simulator
+
+
+def parse_address(address):
+    """Returns (socket family, address) for a (host, port) tuple, 'host:port' or a Unix socket path"""
+    if isinstance(address, tuple):
+        return socket.AF_INET, address
+    if '/' in address or ':' not in address:
+        return socket.AF_UNIX, address
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET, (host or 'localhost', int(port))
+
+
+def connect(address, timeout=None):
+    """Connects to a server at 'address' and returns the transport, see open_url()"""
+    family, address = parse_address(address)
+    sock=socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(address)
+    return simulator.SocketTransport(sock, timeout)
+
+
+def open_url(url, timeout=None):
+    """Returns the transport for 'unix://<path>'"""
+    return connect(url[len('unix://'):], timeout)
+
+
+def open_instrument(address):
+    """Connects to a server at 'address' and returns the model class instance for its instrument"""
+    return arbitrage.Arbitrage(connect(address)).device
+
+
+class InstrumentServer():
+    """Owns the connection to instrument 'gen' and serves it to any number of clients on 'address'.
+    Messages from all clients go through one queue and one thread. Everything that queued up
+    meanwhile is sent as one batch(), so commands of many clients are pipelined.
+    *IDN? is answered from memory, with 'shadow' also the getters covered by the shadow state
+    (see AFGbase.use_shadow_state). The error queue is shared by all clients.
+    A message that cannot be executed is reported on stderr and not answered, the others are served on"""
+    def __init__(self, gen, address, shadow=True):
+        self.gen=gen
+        self.identity=gen.identify()
+        if shadow:
+            gen.use_shadow_state()
+        self.family, self.address = parse_address(address)
+        if self.family == socket.AF_UNIX and os.path.exists(self.address):
+            self.remove_stale(self.address)
+        self.listener=socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family != socket.AF_UNIX:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(self.address)
+        self.listener.listen()
+        self.requests=queue.Queue()
+        self.clients=set()
+        self.lock=threading.Lock()
+        self.running=False
+        self.messages=0
+        self.errors=0
+
+    def remove_stale(self, path):
+        """Removes the socket file 'path' unless a server is still listening on it"""
+        probe=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+        except OSError:
+            pass
+        else:
+            raise OSError('a server is already listening on '+path)
+        finally:
+            probe.close()
+
+    def start(self):
+        """Starts accepting clients and executing their messages in background threads. Returns self"""
+        self.running=True
+        threading.Thread(target=self.accept, daemon=True).start()
+        threading.Thread(target=self.dispatch, daemon=True).start()
+        return self
+
+    def close(self):
+        """Stops serving, disconnects all clients and closes the instrument connection"""
+        self.running=False
+        self.requests.put(None)
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+        if self.family == socket.AF_UNIX:
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+        with self.lock:
+            for conn in self.clients:
+                conn.close()
+            self.clients.clear()
+        self.gen.closecon()
+
+    def accept(self):
+        while self.running:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.clients.add(conn)
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        """Queues the messages arriving from client 'conn' until it disconnects"""
+        rx=bytearray()
+        while self.running:
+            try:
+                data=conn.recv(65536)
+            except OSError:
+                break
+            if not data:
+                break
+            rx+=data
+            while True:
+                msg=simulator.split_message(rx)
+                if msg is None:
+                    break
+                if msg.strip():
+                    self.requests.put((conn, msg))
+        with self.lock:
+            self.clients.discard(conn)
+        conn.close()
+
+    def dispatch(self):
+        """Executes queued messages, all that are waiting at once, and sends the replies back"""
+        while self.running:
+            item=self.requests.get()
+            items=[]
+            while item is not None:
+                items.append(item)
+                try:
+                    item=self.requests.get_nowait()
+                except queue.Empty:
+                    break
+            if not items:
+                return
+            results=[]
+            try:
+                with self.gen.batch():
+                    for conn, msg in items:
+                        results.append((conn, self.attempt(msg)))
+            except Exception as e:
+                self.report(b'; '.join(msg for conn, msg in items), e)
+                continue
+            self.messages+=len(items)
+            for conn, replies in results:
+                values=[r.result() if hasattr(r, 'result') else r for r in replies]
+                if any(v is not None for v in values):
+                    try:
+                        conn.sendall((';'.join(v or '' for v in values)+'\n').encode('ascii'))
+                    except OSError:
+                        pass
+
+    def attempt(self, msg):
+        """execute() that reports a failing message and answers it with nothing, instead of stopping the dispatcher"""
+        try:
+            return self.execute(msg)
+        except (Exception, arbitrage.RangeException) as e:
+            self.report(msg, e)
+            return []
+
+    def report(self, msg, error):
+        self.errors+=1
+        sys.stderr.write('failed to execute '+repr(msg)+': '+repr(error)+'\n')
+
+    def execute(self, msg):
+        """Hands message 'msg' to the instrument, returns the replies (Futures or values) of its queries"""
+        if msg.lstrip(b':').upper().startswith(b'DATA') and b'#' in msg:
+            header, _, block = msg.partition(b'#')
+            start=int(header.split(b',')[1])
+            n=block[0]-48
+            data=block[1+n:1+n+int(block[1:1+n])]
+            self.gen.set_aw_dac(arbitrage.DacBlock(data, self.gen.dacbyteorder), start=start)
+            return []
+        replies=[]
+        for cmd in simulator.split_commands(msg):
+            cmd=cmd.decode('ascii').lstrip(':')
+            if cmd.upper() == '*IDN?':
+                replies.append(self.identity)
+                continue
+            reply=self.gen.msg(cmd)
+            if arbitrage.is_query(cmd):
+                replies.append(reply)
+        return replies
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('instruments', nargs='+', metavar='DEVICE=ADDRESS',
+                        help='port name or URL of an instrument and the Unix socket path or host:port to serve it on')
+    parser.add_argument('--no-shadow', action='store_true', help='always ask the instrument, even for known values')
+    args=parser.parse_args(argv)
+
+    servers=[]
+    for spec in args.instruments:
+        dev, _, address = spec.rpartition('=')
+        if not dev:
+            parser.error('expected DEVICE=ADDRESS, got '+spec)
+        servers.append(InstrumentServer(arbitrage.Arbitrage(dev).device, address, not args.no_shadow).start())
+        print('serving', dev, 'on', address)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+
+import copy
+import os
+import random
+import select
+import socket
+import threading
+import time
+import tty
+import urllib.parse
+
+# long SCPI mnemonics, the upper case part is the short form
+mnemonics=['SOURce','APPLy','SINusoid','SQUare','RAMP','NOISe','USER','FUNCtion','FREQuency','AMPLitude',
+           'DCOffset','DCYCle','SYMMetry','OUTPut','LOAD','VOLTage','UNIT','AM','FM','FSK','STATe','INTernal',
+           'DEPTh','DEViation','RATE','SWEep','STARt','STOP','COUNter','GATe','VALue','DATA','DAC','SYSTem',
+           'ERRor','VOLatile']
+shortforms=dict()
+for m in mnemonics:
+    short=''.join(c for c in m if c.isupper())
+    shortforms[m.upper()]=short
+    shortforms[short]=short
+
+funcs=('SIN','SQU','RAMP','NOIS','USER')
+
+# maximum sine/square frequency per model
+models={
+    'AFG-2005': 5e6,
+    'AFG-2105': 5e6,
+    'AFG-2012': 12e6,
+    'AFG-2112': 12e6,
+    'AFG-2025': 25e6,
+    'AFG-2125': 25e6,
+}
+
+# channel parameters: default, then range for numbers or allowed values for enums
+chanparams={
+    'FUNC': ('SIN', funcs),
+    'FREQ': (1e3, (1e-1, 25e6)),
+    'AMPL': (0.1, (1e-3, 10.0)),
+    'DCO': (0.0, (-5.0, 5.0)),
+    'SQU:DCYC': (50.0, (1.0, 99.0)),
+    'RAMP:SYMM': (100.0, (0.0, 100.0)),
+    'VOLT:UNIT': ('VPP', ('VPP','VRMS','DBM')),
+    'AM:STAT': (False, None),
+    'AM:SOUR': ('INT', ('INT','EXT')),
+    'AM:INT:FUNC': ('SIN', ('SIN','SQU','RAMP')),
+    'AM:INT:FREQ': (100.0, (2e-3, 20e3)),
+    'AM:DEPT': (100.0, (0.0, 120.0)),
+    'FM:STAT': (False, None),
+    'FM:SOUR': ('INT', ('INT','EXT')),
+    'FM:INT:FUNC': ('SIN', ('SIN','SQU','RAMP')),
+    'FM:INT:FREQ': (10.0, (2e-3, 20e3)),
+    'FM:DEV': (100.0, (0.0, 12.5e6)),
+    'FSK:STAT': (False, None),
+    'FSK:SOUR': ('INT', ('INT','EXT')),
+    'FSK:FREQ': (100.0, (1e-1, 25e6)),
+    'FSK:INT:RATE': (10.0, (2e-3, 100e3)),
+    'SWE:STAT': (False, None),
+    'FREQ:STAR': (100.0, (1e-1, 25e6)),
+    'FREQ:STOP': (1e3, (1e-1, 25e6)),
+    'SWE:RATE': (1.0, (1e-3, 500.0)),
+    'SWE:SOUR': ('IMM', ('IMM','EXT')),
+}
+globalparams={
+    'OUTP': (False, None),
+    'OUTP:LOAD': ('DEF', ('DEF','INF')),
+    'COUN:GAT': (0.1, (0.01, 10.0)),
+    'COUN:STAT': (False, None),
+}
+# only available on AFG-21xx models
+modulation=(['AM'],['FM'],['FSK'],['SWE'],['FREQ','STAR'],['FREQ','STOP'],['COUN'])
+
+
+class SCPIError(Exception):
+    """Error pushed to the simulated error queue"""
+    def __init__(self, code, text):
+        super().__init__(code, text)
+        self.code=code
+        self.text=text
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        return format(value, '+.9E')
+    return str(value)
+
+
+def split_message(buf):
+    """Returns the first complete message of bytearray 'buf' and removes it, None if incomplete.
+    Binary blocks (#<n><len><data>) are skipped so their data may contain terminators"""
+    i=0
+    while i < len(buf):
+        c=buf[i]
+        if c == 35 and i+1 < len(buf) and 49 <= buf[i+1] <= 57:
+            n=buf[i+1]-48
+            if len(buf) < i+2+n:
+                return None
+            i=i+2+n+int(buf[i+2:i+2+n])
+            if i > len(buf):
+                return None
+            continue
+        if c in (10, 13):
+            msg=bytes(buf[:i])
+            del buf[:i+1]
+            return msg
+        i+=1
+    return None
+
+
+def split_commands(msg):
+    """Splits message 'msg' at ';' outside of quotes and binary blocks"""
+    cmds=[]
+    start=i=0
+    quoted=False
+    while i < len(msg):
+        c=msg[i]
+        if c == 34:
+            quoted=not quoted
+        elif not quoted and c == 35 and i+1 < len(msg) and 49 <= msg[i+1] <= 57:
+            n=msg[i+1]-48
+            i=i+2+n+int(msg[i+2:i+2+n])
+            continue
+        elif not quoted and c == 59:
+            cmds.append(msg[start:i])
+            start=i+1
+        i+=1
+    cmds.append(msg[start:])
+    return [c.strip() for c in cmds if c.strip()]
+
+
+class SimulatedAFG():
+    """In-process GW Instek AFG-2005/2012/2025/2105/2112/2125.
+    Understands the commands sent by arbitrage.AFGbase/AFG2100, keeps state, an error queue,
+    state registers and an arbitrary waveform memory.
+    'baudrate' models the serial link (10 bits per byte, None for no limit),
+    'latency' the processing time per command in seconds"""
+    def __init__(self, model='AFG-2105', serialnumber='SN000001', baudrate=None, latency=0.0):
+        if model not in models:
+            raise ValueError('Unsupported model '+str(model))
+        self.model=model
+        self.serialnumber=serialnumber
+        self.baudrate=baudrate
+        self.latency=latency
+        self.awpoints=4096
+        self.dacrange=(-511,511)
+        self.registers=dict()
+        self.commands=0
+        self.lock=threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.chans={1: {k: v[0] for k, v in chanparams.items()}}
+        self.globals={k: v[0] for k, v in globalparams.items()}
+        self.arb=[0]*self.awpoints
+        self.errors=[]
+
+    def bytetime(self, n):
+        return 0.0 if not self.baudrate else n*10.0/self.baudrate
+
+    def execute(self, msg):
+        """Executes one message (commands joined by ';'), returns the reply line or None"""
+        replies=[]
+        path=[]
+        for cmd in split_commands(msg):
+            with self.lock:
+                self.commands+=1
+                try:
+                    reply, path = self.command(cmd, path)
+                except SCPIError as e:
+                    self.errors.append(e)
+                    reply=None
+                except (ValueError, IndexError):
+                    self.errors.append(SCPIError(-102, 'Syntax error'))
+                    reply=None
+            if reply is not None:
+                replies.append(reply)
+        return ';'.join(replies) if replies else None
+
+    def command(self, cmd, path):
+        """Executes a single command, 'path' are the header nodes the previous command left.
+        Returns the reply (None for set commands) and the new path"""
+        header, _, args = cmd.partition(b' ')
+        header=header.decode('ascii').upper()
+        if not header.lstrip(':').startswith('DATA'):
+            # only DATA:DAC may carry a binary block
+            args=args.decode('ascii')
+        query=header.endswith('?')
+        header=header.rstrip('?')
+        if header.startswith('*'):
+            return self.common(header, query, args), path
+        if header.startswith(':'):
+            nodes=header[1:].split(':')
+        else:
+            nodes=path+header.split(':')
+        newpath=nodes[:-1]
+        chan=1
+        short=[]
+        for node in nodes:
+            name=node.rstrip('0123456789')
+            name=shortforms.get(name, name)
+            if name == 'SOUR' and not short:
+                chan=int(node[len(node.rstrip('0123456789')):] or 1)
+                if chan not in self.chans:
+                    raise SCPIError(-114, 'Header suffix out of range')
+                continue
+            short.append(name)
+        key=':'.join(short)
+        if not self.model.startswith('AFG-21') and any(short[:len(m)] == m for m in modulation):
+            raise SCPIError(-113, 'Undefined header')
+        if key == 'DATA:DAC':
+            self.data_dac(args)
+            return None, newpath
+        if key == 'SYST:ERR' and query:
+            e=self.errors.pop(0) if self.errors else SCPIError(0, 'No error')
+            return format(e.code, '+d')+',"'+e.text+'"', newpath
+        if key.startswith('APPL'):
+            return self.apply(chan, key, query, args), newpath
+        if key == 'COUN:VAL' and query:
+            freq=self.chans[1]['FREQ']
+            return format_value(freq*(1+1e-7*random.gauss(0, 1))), newpath
+        if key in chanparams:
+            state, spec = self.chans[chan], chanparams[key]
+        elif key in globalparams:
+            state, spec = self.globals, globalparams[key]
+        else:
+            raise SCPIError(-113, 'Undefined header')
+        if query:
+            return format_value(state[key]), newpath
+        state[key]=self.convert(key, spec, args, chan)
+        return None, newpath
+
+    def convert(self, key, spec, args, chan, func=None):
+        """Parses and range checks 'args' for parameter 'key' (frequency limits for function 'func')"""
+        default, allowed = spec
+        arg=args.strip().upper()
+        if isinstance(default, bool):
+            if arg in ('ON','1'):
+                return True
+            if arg in ('OFF','0'):
+                return False
+            raise SCPIError(-224, 'Illegal parameter value')
+        if isinstance(default, str):
+            arg=shortforms.get(arg, arg)
+            if arg not in allowed:
+                raise SCPIError(-224, 'Illegal parameter value')
+            return arg
+        lo, hi = self.limits(key, allowed, func or self.chans[chan]['FUNC'])
+        if arg == 'MIN':
+            return lo
+        if arg == 'MAX':
+            return hi
+        value=float(arg)
+        if not lo <= value <= hi:
+            raise SCPIError(-222, 'Data out of range')
+        return value
+
+    def limits(self, key, allowed, func):
+        if key == 'FREQ':
+            if func in ('RAMP','USER'):
+                return (1e-1, 1e6)
+            return (1e-1, models[self.model])
+        return allowed
+
+    def apply(self, chan, key, query, args):
+        state=self.chans[chan]
+        if query:
+            return ('"'+state['FUNC']+' '+format_value(state['FREQ'])+','+format_value(state['AMPL'])+','
+                    +format_value(state['DCO'])+'"')
+        nodes=key.split(':')
+        func=shortforms.get(nodes[1], nodes[1]) if len(nodes) > 1 else ''
+        if func not in funcs:
+            raise SCPIError(-113, 'Undefined header')
+        values=[a for a in args.split(',') if a.strip()]
+        new=dict(state)
+        new['FUNC']=func
+        for name, value in zip(('FREQ','AMPL','DCO'), values):
+            new[name]=self.convert(name, chanparams[name], value, chan, func)
+        state.update(new)
+        self.globals['OUTP']=True
+        return None
+
+    def data_dac(self, args):
+        """DATA:DAC VOLATILE, <start>, <values or binary block>"""
+        mem, start, data = args.split(b',', 2)
+        if shortforms.get(mem.strip().decode('ascii').upper()) != 'VOL':
+            raise SCPIError(-224, 'Illegal parameter value')
+        start=int(start)
+        data=data.strip()
+        if data.startswith(b'#'):
+            n=data[1]-48
+            length=int(data[2:2+n])
+            raw=data[2+n:2+n+length]
+            values=[int.from_bytes(raw[i:i+2], 'big', signed=True) for i in range(0, len(raw)-1, 2)]
+        else:
+            values=[int(v) for v in data.split(b',')]
+        if start < 0 or start+len(values) > self.awpoints:
+            raise SCPIError(-222, 'Data out of range')
+        if values and (min(values) < self.dacrange[0] or max(values) > self.dacrange[1]):
+            raise SCPIError(-222, 'Data out of range')
+        self.arb[start:start+len(values)]=values
+
+    def common(self, header, query, args):
+        if header == '*IDN' and query:
+            return 'GW INSTEK,'+self.model+','+self.serialnumber+',V1.00'
+        if header == '*OPC':
+            return '1' if query else None
+        if header == '*RST':
+            self.reset()
+            return None
+        if header == '*CLS':
+            self.errors=[]
+            return None
+        if header in ('*SAV','*RCL'):
+            reg=int(args)
+            if not 0 <= reg < 20:
+                raise SCPIError(-222, 'Data out of range')
+            if header == '*SAV':
+                self.registers[reg]=copy.deepcopy(self.arb if reg >= 10 else (self.chans, self.globals))
+            elif reg in self.registers:
+                if reg >= 10:
+                    self.arb=copy.deepcopy(self.registers[reg])
+                    self.chans[1]['FUNC']='USER'
+                else:
+                    self.chans, self.globals = copy.deepcopy(self.registers[reg])
+            return None
+        raise SCPIError(-113, 'Undefined header')
+
+    def serve(self, sock):
+        """Answers messages arriving on 'sock' until it is closed, modelling link and processing time"""
+        rx=bytearray()
+        linkfree=time.monotonic()
+        while True:
+            try:
+                data=sock.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            # bytes arrive no faster than the link allows
+            linkfree=max(time.monotonic(), linkfree)+self.bytetime(len(data))
+            rx+=data
+            while True:
+                msg=split_message(rx)
+                if msg is None:
+                    break
+                if not msg.strip():
+                    continue
+                sleep_until(linkfree)
+                if self.latency:
+                    time.sleep(self.latency)
+                reply=self.execute(msg)
+                if reply is not None:
+                    out=reply.encode('ascii')+b'\n'
+                    time.sleep(self.bytetime(len(out)))
+                    try:
+                        sock.sendall(out)
+                    except OSError:
+                        return
+
+
+def sleep_until(deadline):
+    delay=deadline-time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+
+class SocketTransport():
+    """Serial-port-like connection (the part of the serial.Serial interface arbitrage uses)
+    over the connected stream socket 'sock'"""
+    def __init__(self, sock, timeout=None):
+        self.sock=sock
+        self.sock.setblocking(False)
+        self.timeout=timeout
+        self.is_open=True
+        self.cancelr, self.cancelw = socket.socketpair()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    @property
+    def in_waiting(self):
+        try:
+            return len(self.sock.recv(65536, socket.MSG_PEEK))
+        except (BlockingIOError, InterruptedError):
+            return 0
+
+    def read(self, size=1):
+        """Reads 'size' bytes, less if 'timeout' runs out or the read is cancelled"""
+        data=bytearray()
+        deadline=None if self.timeout is None else time.monotonic()+self.timeout
+        while len(data) < size:
+            wait=None if deadline is None else max(0, deadline-time.monotonic())
+            ready, _, _ = select.select([self.sock, self.cancelr], [], [], wait)
+            if self.cancelr in ready:
+                self.cancelr.recv(64)
+                break
+            if not ready:
+                break
+            try:
+                chunk=self.sock.recv(size-len(data))
+            except (BlockingIOError, InterruptedError):
+                continue
+            if not chunk:
+                break
+            data+=chunk
+        return bytes(data)
+
+    def write(self, data):
+        view=memoryview(data)
+        while view:
+            try:
+                view=view[self.sock.send(view):]
+            except (BlockingIOError, InterruptedError):
+                select.select([], [self.sock], [])
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def cancel_read(self):
+        self.cancelw.send(b'x')
+
+    def reset_input_buffer(self):
+        while self.in_waiting:
+            self.sock.recv(65536)
+
+    def close(self):
+        if self.is_open:
+            self.is_open=False
+            self.sock.close()
+            self.cancelr.close()
+            self.cancelw.close()
+
+
+class SimulatedTransport(SocketTransport):
+    """Connection to a SimulatedAFG served from a thread.
+    Backed by a socket pair, so it has a real file descriptor"""
+    def __init__(self, device=None, timeout=None):
+        self.device=device if device is not None else SimulatedAFG()
+        sock, self.remote = socket.socketpair()
+        super().__init__(sock, timeout)
+        self.thread=threading.Thread(target=self.device.serve, args=(self.remote,), daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.is_open:
+            super().close()
+            self.remote.close()
+
+
+def open_url(url, timeout=None):
+    """Returns a SimulatedTransport for 'sim://<model>?serial=..&baudrate=..&latency=..',
+    e.g. 'sim://AFG-2105?baudrate=9600&latency=0.002'"""
+    parts=urllib.parse.urlsplit(url)
+    query=dict(urllib.parse.parse_qsl(parts.query))
+    device=SimulatedAFG(model=parts.netloc.upper() or 'AFG-2105',
+                        serialnumber=query.get('serial', 'SN000001'),
+                        baudrate=float(query['baudrate']) if 'baudrate' in query else None,
+                        latency=float(query.get('latency', 0.0)))
+    return SimulatedTransport(device, timeout)
+
+
+class PtyEnd():
+    """Socket-like wrapper (recv, sendall) around the master side of a pseudo terminal"""
+    def __init__(self, fd):
+        self.fd=fd
+
+    def recv(self, size):
+        try:
+            return os.read(self.fd, size)
+        except OSError:
+            # EIO once the slave side is closed
+            return b''
+
+    def sendall(self, data):
+        view=memoryview(data)
+        while view:
+            view=view[os.write(self.fd, view):]
+
+
+def serve_pty(device=None):
+    """Serves 'device' (default: a new SimulatedAFG) on a pseudo terminal.
+    Returns the slave's port name, which can be opened like a real serial port"""
+    device=device if device is not None else SimulatedAFG()
+    master, slave = os.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    name=os.ttyname(slave)
+    threading.Thread(target=device.serve, args=(PtyEnd(master),), daemon=True).start()
+    return name
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import arbitrage
+
+
+@pytest.fixture
+def gen():
+    """AFG-2105 model class on a simulated instrument"""
+    device=arbitrage.Arbitrage('sim://AFG-2105').device
+    yield device
+    device.closecon()
+
+
+@pytest.fixture(autouse=True)
+def cachedir(tmp_path, monkeypatch):
+    """Keeps identity and register caches out of the user's cache directory"""
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    return tmp_path
@@ -0,0 +1,161 @@
+import time
+from concurrent import futures
+
+import numpy as np
+import pytest
+
+import arbitrage
+import group
+import sequencer
+
+
+def test_sync_reports_errors(gen):
+    gen.sync()
+    gen.set_freq(2000)
+    gen.msg('NOPE 1')
+    with pytest.raises(arbitrage.CommandError) as info:
+        gen.sync()
+    assert info.value.errors[0][0] == -113
+    gen.sync()
+
+
+def test_fence(gen):
+    with gen.fence():
+        gen.set_freq(3000)
+    with pytest.raises(arbitrage.CommandError):
+        with gen.fence():
+            gen.msg('NOPE')
+
+
+def test_batch_raising_sends_nothing(gen):
+    with pytest.raises(ValueError):
+        with gen.batch():
+            gen.set_freq(5000)
+            raise ValueError
+    assert gen.get_freq() == 1000.0
+
+
+def test_batch_only_buffers_own_thread(gen):
+    stream=gen.stream_counter(gate=0.01)
+    time.sleep(0.05)
+    with gen.batch():
+        freq=gen.get_freq()
+        time.sleep(0.2)
+    time.sleep(0.05)
+    stream.stop()
+    assert freq.result() == 1000.0
+    assert stream.gaps == 0
+    assert stream.count > 15
+
+
+def test_shadow_state_skips_redundant_traffic(gen):
+    gen.use_shadow_state()
+    stats=gen.use_stats()
+    gen.set_freq(2000)
+    gen.set_freq(2000)
+    assert gen.get_freq() == 2000.0
+    assert gen.get_amp() == 0.1
+    assert gen.get_amp() == 0.1
+    gen.set_func('SQU')
+    assert gen.get_freq() == 2000.0
+    commands=stats.snapshot()['commands']
+    assert commands['SOURCE1:FREQ']['count'] == 1
+    assert commands['SOURCE1:AMPL?']['count'] == 1
+    assert commands['SOURCE1:FREQ?']['count'] == 1
+    assert (gen.shadow.skipped, gen.shadow.served) == (1, 2)
+
+
+def test_coalescing_writes_latest_value(gen):
+    gen.use_coalescing(rate=10)
+    for freq in range(1001, 1051):
+        gen.set_freq(freq)
+    assert gen.get_freq() == 1050.0
+    assert gen.coalescer.received == 50
+    assert gen.coalescer.written <= 3
+    gen.set_amp(1)
+    gen.set_amp(2)
+    time.sleep(0.3)
+    assert gen.ser.device.chans[1]['AMPL'] == 2.0
+    gen.use_coalescing(None)
+    assert gen.get_amp() == 2.0
+
+
+def test_command_encodes_line(gen):
+    command=next(cmd for cmd in arbitrage.basecommands if cmd.name == 'set_freq')
+    assert command.literals == [b'SOURCE', b':FREQ ', b'\r']
+    assert command.encode(gen, (2000,), {'chan': 1}) == ('SOURCE1:FREQ 2000', b'SOURCE1:FREQ 2000\r')
+    with pytest.raises(arbitrage.RangeException):
+        command.encode(gen, (2000,), {'chan': 3})
+
+
+def test_counter_counts_bad_readings_as_gaps(gen):
+    read=gen.get_fc_value
+    calls=[]
+    def flaky():
+        calls.append(None)
+        if len(calls)%3 == 0:
+            raise ValueError("'Overflow' is no float")
+        return read()
+    gen.get_fc_value=flaky
+    stream=gen.stream_counter(gate=0.01)
+    time.sleep(0.1)
+    assert stream.start() is stream
+    time.sleep(0.1)
+    thread=stream.thread
+    stream.stop()
+    assert not thread.is_alive()
+    assert stream.gaps >= 3
+    assert stream.count+stream.gaps == len(calls)
+
+
+def test_limits_checked_locally(gen):
+    gen.use_shadow_state()
+    with pytest.raises(arbitrage.RangeException):
+        gen.set_amp(99)
+    with pytest.raises(arbitrage.RangeException):
+        gen.set_freq(1e9)
+    assert gen.get_amp() == 0.1
+    gen.get_output_load()
+    gen.get_volt_units()
+    gen.set_offset(1)
+    with pytest.raises(arbitrage.RangeException):
+        gen.set_amp(9)
+    gen.set_amp(8)
+    gen.sync()
+
+
+def test_sweep_follows_schedule(gen):
+    table=[(0.02*i, 1000+100*i, None if i else 1.0, float('nan')) for i in range(10)]
+    sweep=sequencer.Sweep(gen, table, late=0.05)
+    assert sweep.lines[1][0] == 'SOURCE1:FREQ 1100'
+    report=sweep.run()
+    assert report['sent'] == 10 and report['missed'] == 0
+    assert report['duration'] >= 0.17
+    assert abs(report['mean_error']) < 0.01
+    assert gen.get_freq() == 1900.0
+    assert gen.get_amp() == 1.0
+
+
+def test_scan_waits_for_measurement(gen):
+    def read():
+        time.sleep(0.02)
+        return gen.get_freq()
+    with futures.ThreadPoolExecutor(1) as pool:
+        scan=sequencer.Scan(gen, lambda freq, amp, off: pool.submit(read), freq=[1000, 2000, 3000], amp=[1, 2])
+        results=scan.run()
+    assert results['done'].all()
+    assert np.array_equal(results['value'], results['freq'])
+
+
+def test_group_configures_each_member(gen):
+    other=arbitrage.Arbitrage('sim://AFG-2105').device
+    members=group.Group([gen, other])
+    try:
+        freqs={gen: 2000, other: 3000}
+        report=members.configure(lambda member: member.set_freq(freqs[member]))
+        assert len(report['written']) == 2
+        assert members.get_freq() == [2000.0, 3000.0]
+        assert members.get_output_enabled() == [True, True]
+    finally:
+        other.closecon()
+        members.executor.shutdown()
@@ -0,0 +1,180 @@
+import asyncio
+import time
+
+import arbitrage
+import replay
+
+
+def test_pipelined_replies_in_order(gen):
+    futs=[]
+    for freq in (1000, 2000, 3000):
+        gen.set_freq(freq)
+        fut=gen.new_future()
+        gen.send('SOURCE1:FREQ?', fut)
+        futs.append(fut)
+    assert [float(fut.result(1)) for fut in futs] == [1000, 2000, 3000]
+
+
+def test_batch_splits_reply(gen):
+    with gen.batch():
+        freq=gen.get_freq()
+        amp=gen.get_amp()
+        gen.set_offset(0.5)
+        offset=gen.get_offset()
+    assert (freq.result(), amp.result(), offset.result()) == (1000.0, 0.1, 0.5)
+
+
+def test_unanswered_query_resyncs(gen):
+    gen.replytimeout=0.2
+    assert gen.msg('SOURCE1:BOGUS?') is None
+    assert gen.resyncs >= 1
+    gen.set_freq(1234)
+    assert [gen.get_freq() for i in range(3)] == [1234.0]*3
+
+
+def test_slow_device_answers_on_retry(gen):
+    for i in range(30):
+        gen.get_freq()
+    gen.ser.device.latency=0.3
+    assert gen.get_freq() == 1000.0
+    gen.ser.device.latency=0.0
+    assert gen.get_freq() == 1000.0
+
+
+def test_async_unanswered_query_resyncs():
+    async def run():
+        g=await arbitrage.AsyncAFG.open('sim://AFG-2105')
+        g.replytimeout=0.2
+        try:
+            assert await g.msg('SOURCE1:BOGUS?') is None
+            await g.set_freq(1234)
+            assert [await g.get_freq() for i in range(3)] == [1234.0]*3
+            assert await asyncio.gather(g.get_freq(), g.get_amp()) == [1234.0, 0.1]
+        finally:
+            g.closecon()
+    asyncio.run(run())
+
+
+def test_command_key():
+    assert arbitrage.command_key(':SOURCE1:FREQ 10') == 'SOURCE1:FREQ'
+    assert arbitrage.command_key('source1:freq?') == 'SOURCE1:FREQ?'
+    assert arbitrage.command_key('*OPC?;:SYST:ERR?') == '*OPC?'
+
+
+def test_joined_line_keeps_override():
+    timeouts=arbitrage.ReplyTimeouts()
+    for i in range(10):
+        timeouts.learn('*OPC?;:SYST:ERR?', 0.001)
+    assert timeouts.timeout('*OPC?;:SYST:ERR?;:SYST:ERR?', 1.0) >= timeouts.overrides['*OPC?']
+
+
+def test_backoff_doubles_timeout():
+    timeouts=arbitrage.ReplyTimeouts()
+    for i in range(30):
+        timeouts.learn('SOURCE1:FREQ?', 0.0001)
+    first=timeouts.timeout('SOURCE1:FREQ?', 1.0)
+    assert first == timeouts.minimum
+    timeouts.backoff('SOURCE1:FREQ?', 1.0)
+    assert timeouts.timeout('SOURCE1:FREQ?', 1.0) == 2*first
+    timeouts.backoff('SOURCE1:FREQ?', 1.0, observed=0.7)
+    assert timeouts.timeout('SOURCE1:FREQ?', 1.0) == 0.7
+    timeouts.learn('SOURCE1:FREQ?', 0.0001)
+    assert timeouts.timeout('SOURCE1:FREQ?', 1.0) == first
+
+
+def test_fence_after_fast_fences(gen):
+    for i in range(10):
+        gen.sync()
+    gen.ser.device.latency=0.1
+    gen.set_freq(1000)
+    start=time.monotonic()
+    gen.sync()
+    assert time.monotonic()-start < 5
+
+
+def test_reply_right_after_timeout(gen):
+    class LateWaiter(arbitrage.Future):
+        def result(self, timeout=None):
+            try:
+                return super().result(timeout)
+            except arbitrage.futures.TimeoutError:
+                # the waiter is scheduled late, meanwhile the reply arrives
+                time.sleep(0.1)
+                raise
+    gen.new_future=LateWaiter
+    gen.replytimeout=0.05
+    gen.ser.device.latency=0.08
+    assert gen.get_freq() == 1000.0
+    gen.ser.device.latency=0.0
+    del gen.new_future
+    assert gen.reader.is_alive()
+    assert gen.get_amp() == 0.1
+    assert gen.resyncs == 0
+
+
+def test_reply_time_counts_from_send(gen):
+    gen.ser.device.latency=0.01
+    futs=[]
+    for i in range(10):
+        fut=gen.new_future()
+        gen.send('SOURCE1:FREQ?', fut)
+        futs.append(fut)
+    time.sleep(0.3)
+    for fut in futs:
+        assert float(gen.wait_reply(fut, 'SOURCE1:FREQ?')) == 1000
+    srtt, rttvar = gen.timeouts.estimates['SOURCE1:FREQ?']
+    assert srtt > 0.1
+
+
+def test_stats_count_joined_commands_by_header(gen):
+    stats=gen.use_stats()
+    with gen.batch():
+        gen.get_freq()
+        gen.set_offset(0.5)
+        gen.get_amp()
+    commands=stats.snapshot()['commands']
+    assert commands['SOURCE1:FREQ?']['count'] == 1
+    assert commands['SOURCE1:DCO']['read'] == 0
+    assert commands['SOURCE1:FREQ?']['read']+commands['SOURCE1:AMPL?']['read'] > 2
+    text=gen.stats_prometheus(labels={'device': 'afg'})
+    assert 'arbitrage_commands_total{command="SOURCE1:AMPL?",device="afg"} 1\n' in text
+    assert 'arbitrage_command_latency_seconds_count{command="SOURCE1:FREQ?",device="afg"} 1\n' in text
+    assert 'BATCH' not in text
+
+
+def test_replay_answers_recorded_session(tmp_path):
+    path=str(tmp_path/'session.arblog')
+    def session(dev):
+        gen=arbitrage.Arbitrage(dev).device
+        gen.set_freq(2500)
+        with gen.batch():
+            freq=gen.get_freq()
+            amp=gen.get_amp()
+        replies=(freq.result(), amp.result(), gen.get_offset())
+        transport=gen.ser
+        gen.closecon()
+        return replies, transport
+    recorded, transport = session(replay.record('sim://AFG-2105', path))
+    replayed, transport = session('replay://'+path+'?speed=0')
+    assert replayed == recorded == (2500.0, 0.1, 0.0)
+    assert transport.mismatches == []
+    assert transport.finished()
+
+
+def test_discover_uses_identity_cache(cachedir):
+    ports=[('sim://AFG-2105', 'SN1'), ('sim://AFG-2005', 'SN2'), 'loop://']
+    cache=arbitrage.IdentityCache()
+    cache.set('sim://AFG-2005', 'SN2', 'GW INSTEK,AFG-9999,SN2,V1.00')
+    cache.save()
+    for attempt in range(2):
+        found=arbitrage.discover(ports)
+        try:
+            assert sorted(found) == ['sim://AFG-2005', 'sim://AFG-2105']
+            assert isinstance(found['sim://AFG-2105'].device, arbitrage.AFG2105)
+            assert found['sim://AFG-2005'].device.get_freq() == 1000.0
+        finally:
+            for arb in found.values():
+                arb.device.closecon()
+    entries=arbitrage.IdentityCache().entries
+    assert sorted(entries) == ['sim://AFG-2005|SN2', 'sim://AFG-2105|SN1']
+    assert 'AFG-2005' in entries['sim://AFG-2005|SN2']
@@ -0,0 +1,42 @@
+import json
+import socket
+import time
+
+import arbitrage
+import server
+
+
+def test_bad_message_keeps_serving(tmp_path, capsys):
+    address=str(tmp_path/'afg.sock')
+    srv=server.InstrumentServer(arbitrage.Arbitrage('sim://AFG-2105').device, address).start()
+    try:
+        bad=socket.socket(socket.AF_UNIX)
+        bad.connect(address)
+        bad.sendall(b'DATA:DAC #15abcde\n\xff\xfe?\n')
+        time.sleep(0.2)
+        bad.close()
+        client=server.open_instrument(address)
+        try:
+            client.set_freq(2500)
+            assert client.get_freq() == 2500.0
+        finally:
+            client.closecon()
+        assert srv.errors == 2
+    finally:
+        srv.close()
+
+
+def test_cli_streams_recipe(tmp_path, capsys):
+    recipe=tmp_path/'recipe.scpi'
+    recipe.write_text('# set, then read back\nSOURCE1:FREQ 2000\nSOURCE1:FREQ?\n\nSOURCE1:AMPL?\n')
+    output=tmp_path/'results.jsonl'
+    assert arbitrage.main(['sim://AFG-2105', str(recipe), '-f', 'jsonl', '-n', '2', '-o', str(output)]) == 0
+    results=[json.loads(line) for line in output.read_text().splitlines()]
+    assert [(r['pass'], r['line'], r['command']) for r in results] == [
+        (0, 3, 'SOURCE1:FREQ?'), (0, 5, 'SOURCE1:AMPL?'), (1, 3, 'SOURCE1:FREQ?'), (1, 5, 'SOURCE1:AMPL?')]
+    assert [float(r['reply']) for r in results] == [2000, 0.1, 2000, 0.1]
+    recipe.write_text('SOURCE1:NOPE 1\n')
+    assert arbitrage.main(['sim://AFG-2105', str(recipe)]) == 1
+    out, err = capsys.readouterr()
+    assert out.splitlines() == ['time,pass,line,command,reply']
+    assert 'SOURCE1:NOPE 1' in err
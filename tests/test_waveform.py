@@ -0,0 +1,83 @@
+import functools
+
+import numpy as np
+import pytest
+
+import arbitrage
+import waveform
+
+
+def test_callable_shapes_not_confused():
+    blocks=[waveform.encode(lambda n, c=c: waveform.sine(n, cycles=c), 256) for c in (1, 2, 3)]
+    assert len(set(blocks)) == 3
+    assert waveform.encode(functools.partial(waveform.sine, cycles=2), 256) == blocks[1]
+
+
+def test_explicit_key_is_cached():
+    cache=waveform.BlockCache()
+    first=waveform.encode(lambda n: waveform.sine(n), 256, cache=cache, key='sine')
+    assert waveform.encode(lambda n: waveform.square(n), 256, cache=cache, key='sine') is first
+    assert cache.hits == 1
+
+
+def test_named_shapes_are_cached():
+    cache=waveform.BlockCache()
+    waveform.encode('SIN', 256, cache=cache, cycles=2)
+    waveform.encode('SIN', 256, cache=cache, cycles=2)
+    waveform.encode('SIN', 256, cache=cache, cycles=3)
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_registers_least_recently_used(gen):
+    registers=waveform.WaveformRegisters(gen, registers=range(10, 12))
+    used=[registers.use_waveform('SIN', cycles=c) for c in (1, 2, 1, 3)]
+    assert used == [10, 11, 10, 11]
+    assert registers.hits == 1
+    slots=registers.index.slots(registers.instrument)
+    slots.clear()
+    assert len(registers.stored()) == 2
+
+
+def test_registers_take_only_encoded_blocks(gen):
+    registers=waveform.WaveformRegisters(gen, registers=range(10, 12))
+    block=waveform.encode('SIN', gen.awpoints, gen.dacrange, gen.dacbyteorder)
+    assert registers.use_waveform(block) == 10
+    assert registers.use_waveform('SIN') == 10
+    with pytest.raises(KeyError):
+        registers.use_waveform(np.zeros(gen.awpoints, dtype='>i2').tobytes())
+
+
+def test_dac_upload_progress_may_send(gen):
+    block=np.arange(-500, 500, dtype=np.int16)
+    stream=gen.stream_counter(gate=0.01)
+    seen=[]
+    def progress(sent, total, rate):
+        seen.append((sent, gen.get_freq()))
+    try:
+        gen.set_aw_dac(block, progress=progress, chunksize=500)
+        gen.sync()
+    finally:
+        stream.stop()
+    assert seen == [(500, 1000.0), (1000, 1000.0), (1500, 1000.0), (2000, 1000.0)]
+    assert gen.ser.device.arb[:1000] == block.tolist()
+    assert stream.gaps == 0
+    with gen.capture() as cmds:
+        gen.set_aw_dac(block[:3], start=5)
+    assert cmds == ['DATA:DAC VOLATILE, 5, -500, -499, -498']
+
+
+def test_file_source_decimates(tmp_path):
+    rate=10000.0
+    t=np.arange(200000)/rate
+    # slow sine plus a tone far above the new Nyquist frequency
+    signal=1000*np.sin(2*np.pi*0.5*t)+800*np.sin(2*np.pi*3000*t)
+    path=str(tmp_path/'signal.raw')
+    signal.astype('<i2').tofile(path)
+    source=waveform.FileSource(path, rate=rate)
+    window=(2.0, 12.0)
+    samples=source.samples(512, window=window, chunksize=4096)
+    centres=window[0]+(np.arange(512)+0.5)*(window[1]-window[0])/512
+    assert np.sqrt(np.mean((samples-1000*np.sin(2*np.pi*0.5*centres))**2)) < 20
+    assert np.array_equal(samples, source.samples(512, window=window, chunksize=1 << 20))
+    block=waveform.encode(source, 512, window=window)
+    assert isinstance(block, arbitrage.DacBlock) and len(block) == 1024
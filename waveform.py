@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+
+import collections
+import hashlib
+import os
+import numpy as np
+
+import arbitrage
+
+##############################
+#         SYNTHESIS          #
+##############################
+# All shapes cover one period of 'npoints' samples and return floats, nominally in -1..1
+
+def timebase(npoints):
+    """Returns the sample positions 0 <= t < 1 of one period of 'npoints' samples"""
+    return np.arange(npoints)/npoints
+
+def sine(npoints, cycles=1, phase=0):
+    """'cycles' periods of a sine, 'phase' in radians"""
+    return np.sin(2*np.pi*cycles*timebase(npoints)+phase)
+
+def square(npoints, cycles=1, duty=50):
+    """'cycles' periods of a square wave with duty cycle 'duty' in percent"""
+    return np.where((cycles*timebase(npoints))%1 < duty/100, 1.0, -1.0)
+
+def ramp(npoints, cycles=1, symmetry=100):
+    """'cycles' periods of a ramp, 'symmetry' in percent (50 gives a triangle)"""
+    t=(cycles*timebase(npoints))%1
+    s=symmetry/100
+    up=2*t/s-1 if s > 0 else np.full(npoints, 1.0)
+    down=1-2*(t-s)/(1-s) if s < 1 else np.full(npoints, 1.0)
+    return np.where(t < s, up, down)
+
+def triangle(npoints, cycles=1):
+    """'cycles' periods of a triangle"""
+    return ramp(npoints, cycles=cycles, symmetry=50)
+
+def harmonics(npoints, amplitudes=(1,), phases=None):
+    """Sum of sine harmonics, amplitudes[k] (and phases[k] in radians) belong to harmonic k+1"""
+    amplitudes=np.asarray(amplitudes, dtype=float)
+    order=np.arange(1, len(amplitudes)+1)
+    phases=np.zeros(len(amplitudes)) if phases is None else np.asarray(phases, dtype=float)
+    return np.sin(np.outer(2*np.pi*timebase(npoints), order)+phases) @ amplitudes
+
+def gaussian_pulses(npoints, centers=(0.5,), widths=(0.05,), amplitudes=None):
+    """Sum of gaussian pulses at 'centers' with standard deviations 'widths' (both as fraction of the period).
+    Pulses wrap around the period boundary"""
+    centers=np.asarray(centers, dtype=float)
+    widths=np.broadcast_to(np.asarray(widths, dtype=float), centers.shape)
+    amplitudes=np.ones(len(centers)) if amplitudes is None else np.asarray(amplitudes, dtype=float)
+    d=(timebase(npoints)[:, None]-centers[None, :]+0.5)%1-0.5
+    return np.exp(-0.5*(d/widths)**2) @ amplitudes
+
+def chirp(npoints, f0=1, f1=10, method='linear', phase=0):
+    """Sine sweeping from 'f0' to 'f1' cycles per period, 'method' is 'linear' or 'exponential'"""
+    t=timebase(npoints)
+    if method == 'linear':
+        cycles=f0*t+(f1-f0)*t**2/2
+    elif method == 'exponential':
+        k=np.log(f1/f0)
+        cycles=f0*np.expm1(k*t)/k
+    else:
+        raise arbitrage.RangeException
+    return np.sin(2*np.pi*cycles+phase)
+
+def piecewise(npoints, segments=()):
+    """Concatenates 'segments', a list of (duration, samples) pairs.
+    Each segment is resampled to its share of 'npoints' according to its relative duration"""
+    durations=np.array([d for d, _ in segments], dtype=float)
+    bounds=np.rint(np.concatenate(([0], np.cumsum(durations)))/durations.sum()*npoints).astype(int)
+    out=np.empty(npoints)
+    for (duration, samples), start, stop in zip(segments, bounds[:-1], bounds[1:]):
+        out[start:stop]=resample(np.asarray(samples, dtype=float), stop-start, periodic=False)
+    return out
+
+shapes={
+    'SIN': sine,
+    'SQUARE': square,
+    'RAMP': ramp,
+    'TRIANGLE': triangle,
+    'HARMONICS': harmonics,
+    'GAUSSIAN': gaussian_pulses,
+    'CHIRP': chirp,
+    'PIECEWISE': piecewise,
+}
+
+def synthesize(shape, npoints=4096, **params):
+    """Returns one period of 'shape' (a key of 'shapes' or a callable taking npoints) with 'npoints' samples"""
+    func=shape if callable(shape) else shapes[shape.upper()]
+    return func(npoints, **params)
+
+##############################
+#        QUANTIZATION        #
+##############################
+def resample(samples, npoints, periodic=True):
+    """Linearly resamples 'samples' to 'npoints' samples.
+    A periodic waveform wraps around, otherwise first and last sample are kept"""
+    samples=np.asarray(samples)
+    n=len(samples)
+    if n == npoints:
+        return samples
+    if periodic:
+        return np.interp(np.arange(npoints)*(n/npoints), np.arange(n), samples, period=n)
+    if n == 1 or npoints == 1:
+        return np.full(npoints, samples[0], dtype=float)
+    return np.interp(np.linspace(0, n-1, npoints), np.arange(n), samples)
+
+def quantize(samples, dacrange=(-511,511), normalize=True):
+    """Returns 'samples' rounded to int16 DAC values and clipped to 'dacrange'.
+    With 'normalize' the peak magnitude is scaled to the full DAC range first"""
+    samples=np.asarray(samples, dtype=float)
+    if normalize:
+        peak=np.max(np.abs(samples)) if samples.size else 0
+        if peak > 0:
+            samples=samples*(min(dacrange[1], -dacrange[0])/peak)
+    return np.clip(np.rint(samples), dacrange[0], dacrange[1]).astype(np.int16)
+
+##############################
+#        FILE SOURCES        #
+##############################
+class FileSource():
+    """Recorded signal in a file too large to load, read through a memory map.
+    'path' is a .npy file or raw samples of 'dtype' (default int16, little endian) after 'offset' header bytes,
+    'channels' interleaved of which 'channel' is used. 'rate' is the sample rate in Hz, windows are given
+    in seconds. Samples are multiplied by 'scale', e.g. to map the file's full scale onto the DAC range.
+    Only the chunks of the selected window are read, memory use does not depend on the file size"""
+    def __init__(self, path, rate=1.0, dtype='<i2', offset=0, channels=1, channel=0, scale=1.0):
+        self.path=os.path.abspath(path)
+        self.rate=float(rate)
+        self.scale=scale
+        if path.endswith('.npy'):
+            data=np.load(path, mmap_mode='r')
+        else:
+            dtype=np.dtype(dtype)
+            n=(os.path.getsize(path)-offset)//(dtype.itemsize*channels)
+            data=np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(n, channels))
+        if data.ndim == 2:
+            data=data[:, channel]
+        elif data.ndim != 1 or channel != 0:
+            raise ValueError(path+' holds no channel '+str(channel))
+        self.data=data
+        stat=os.stat(path)
+        self.signature=(self.path, stat.st_size, stat.st_mtime_ns, data.dtype.str, offset, channels, channel)
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def duration(self):
+        return len(self.data)/self.rate
+
+    def key(self):
+        """Identifies the file content and settings, used as cache key by encode()"""
+        return self.signature+(self.rate, self.scale)
+
+    def span(self, window=None):
+        """Returns the sample range (first, stop) of 'window' (t0, t1) in seconds, default the whole file.
+        Raises RangeException if it is empty or outside the file"""
+        if window is None:
+            return 0, len(self.data)
+        first, stop = (int(round(t*self.rate)) for t in window)
+        if not 0 <= first < stop <= len(self.data):
+            raise arbitrage.RangeException
+        return first, stop
+
+    def samples(self, npoints, window=None, oversample=16, chunksize=1<<20):
+        """Returns 'window' (see span()) resampled to 'npoints' samples.
+        The window is read 'chunksize' samples at a time and averaged into 'oversample'*'npoints' bins
+        (a boxcar filter), which a windowed-sinc lowpass at the new Nyquist frequency then brings to 'npoints'.
+        Output point k lies at the centre of the k-th of 'npoints' equal parts of the window"""
+        first, stop = self.span(window)
+        n=stop-first
+        m=min(n, oversample*npoints)
+        edges=first+np.arange(m+1)*n//m
+        sums=np.zeros(m)
+        for a in range(first, stop, chunksize):
+            b=min(a+chunksize, stop)
+            # the bins i0..i1-1 overlap this chunk, the first may have started in the previous one
+            i0=np.searchsorted(edges, a, 'right')-1
+            i1=np.searchsorted(edges, b, 'left')
+            cuts=edges[i0:i1]-a
+            cuts[0]=0
+            sums[i0:i1]+=np.add.reduceat(np.asarray(self.data[a:b], dtype=float), cuts)
+        bins=sums/np.diff(edges)
+        ratio=m/npoints
+        if ratio > 1:
+            bins=lowpass(bins, 0.45/ratio, int(4*ratio))
+        positions=(np.arange(npoints)+0.5)*ratio-0.5
+        return self.scale*np.interp(positions, np.arange(m), bins)
+
+def lowpass(samples, cutoff, halfwidth):
+    """Filters 'samples' with a Blackman windowed-sinc FIR of 2*'halfwidth'+1 taps,
+    'cutoff' in cycles per sample. The ends are extended by point reflection, which keeps linear trends"""
+    halfwidth=max(0, min(halfwidth, len(samples)-1))
+    t=np.arange(-halfwidth, halfwidth+1)
+    taps=2*cutoff*np.sinc(2*cutoff*t)*np.blackman(len(t)) if halfwidth else np.ones(1)
+    taps/=taps.sum()
+    padded=np.pad(samples, halfwidth, mode='reflect', reflect_type='odd')
+    return np.convolve(padded, taps, mode='valid')
+
+##############################
+#           CACHE            #
+##############################
+def digest(obj, h=None):
+    """Returns a content hash of 'obj' built from nested dicts, sequences, arrays and scalars.
+    Raises TypeError for callables"""
+    top=h is None
+    if top:
+        h=hashlib.blake2b(digest_size=16)
+    if isinstance(obj, np.ndarray):
+        h.update(b'A'+obj.dtype.str.encode()+repr(obj.shape).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, dict):
+        h.update(b'D%d' % len(obj))
+        for key in sorted(obj, key=repr):
+            digest(key, h)
+            digest(obj[key], h)
+    elif isinstance(obj, (list, tuple)):
+        h.update(b'L%d' % len(obj))
+        for item in obj:
+            digest(item, h)
+    elif callable(obj):
+        # a name says nothing about closures, default arguments or partial()
+        raise TypeError('cannot hash callable '+repr(obj)+' by content')
+    else:
+        h.update(b'S'+repr(obj).encode())
+    if top:
+        return h.hexdigest()
+
+class BlockCache():
+    """LRU cache of encoded DAC blocks keyed by the content hash of the waveform description"""
+    def __init__(self, maxsize=256):
+        self.maxsize=maxsize
+        self.blocks=collections.OrderedDict()
+        self.hits=0
+        self.misses=0
+
+    def get(self, key, build):
+        """Returns the block stored under 'key', calling build() to create it on a miss"""
+        block=self.blocks.get(key)
+        if block is not None:
+            self.hits+=1
+            self.blocks.move_to_end(key)
+            return block
+        self.misses+=1
+        block=build()
+        self.blocks[key]=block
+        if len(self.blocks) > self.maxsize:
+            self.blocks.popitem(last=False)
+        return block
+
+    def clear(self):
+        self.blocks.clear()
+
+cache=BlockCache()
+
+def encode(shape, npoints=4096, dacrange=(-511,511), byteorder='big', normalize=True, cache=cache, key=None, **params):
+    """Returns 'shape' synthesized with 'params', quantized to 'dacrange' and encoded for set_aw_dac.
+    'shape' can also be an array of samples, which is resampled to 'npoints', or a FileSource,
+    whose 'window' (t0, t1) in seconds is decimated to 'npoints' (see FileSource.samples).
+    Results are cached under the hash of all arguments, a hit skips synthesis and encoding.
+    Callables cannot be hashed, a callable shape (or parameter) is only cached under an explicit 'key'
+    that identifies it together with its parameters"""
+    try:
+        if key is not None:
+            key=digest((key, npoints, tuple(dacrange), byteorder, normalize))
+        else:
+            ident=shape.key() if isinstance(shape, FileSource) else shape
+            key=digest((ident, npoints, tuple(dacrange), byteorder, normalize, params))
+    except TypeError:
+        cache=None
+    def build():
+        if isinstance(shape, FileSource):
+            samples=shape.samples(npoints, **params)
+        elif isinstance(shape, np.ndarray):
+            samples=resample(shape, npoints)
+        else:
+            samples=synthesize(shape, npoints, **params)
+        words=arbitrage.dac_block(quantize(samples, dacrange, normalize), dacrange, byteorder)
+        return arbitrage.DacBlock(words, byteorder)
+    if cache is None:
+        return build()
+    return cache.get(key, build)
+
+def upload(gen, shape, normalize=True, **kwargs):
+    """Encodes 'shape' for device 'gen' (its awpoints, dacrange and dacbyteorder) and uploads it.
+    Keyword arguments of set_aw_dac (start, progress, chunksize) are passed on, the rest go to the shape"""
+    upload_args={k: kwargs.pop(k) for k in ('start', 'progress', 'chunksize') if k in kwargs}
+    block=encode(shape, gen.awpoints, gen.dacrange, gen.dacbyteorder, normalize, **kwargs)
+    return gen.set_aw_dac(block, **upload_args)
+
+##############################
+#         REGISTERS          #
+##############################
+class RegisterIndex(arbitrage.JSONStore):
+    """Persistent record of the waveforms stored in the registers of each instrument.
+    Per instrument (manufacturer, model and serial number from *idn?) a list of
+    [register, content hash] pairs is kept, least recently used first.
+    Stored as JSON in 'path' (default $XDG_CACHE_HOME/arbitrage/registers.json)"""
+    def __init__(self, path=None):
+        super().__init__('registers.json', path)
+
+    def slots(self, instrument):
+        """Returns a copy of the (register, hash) list of 'instrument', least recently used first"""
+        with self.lock:
+            return [tuple(slot) for slot in self.entries.get(instrument, [])]
+
+    def assign(self, instrument, register, key=None):
+        """Records that 'register' of 'instrument' holds the waveform with hash 'key', as most recently used.
+        Without 'key' the register is forgotten"""
+        with self.lock:
+            slots=[slot for slot in self.entries.get(instrument, []) if slot[0] != register]
+            if key is not None:
+                slots.append([register, key])
+            self.entries[instrument]=slots
+
+    def forget(self, instrument):
+        """Drops everything known about 'instrument', e.g. after registers were overwritten on the front panel"""
+        with self.lock:
+            self.entries.pop(instrument, None)
+        self.save()
+
+class WaveformRegisters():
+    """Keeps arbitrary waveforms in the registers 10-19 of device 'gen' and recalls them instead of uploading again.
+    Waveforms are identified by the hash of their encoded DAC block, which register holds which is
+    remembered in 'index' (a RegisterIndex, default location) across sessions.
+    When all 'registers' are taken the least recently used one is overwritten"""
+    def __init__(self, gen, index=None, registers=range(10,20)):
+        if any(reg not in range(10,20) for reg in registers):
+            raise arbitrage.RangeException
+        info=gen.identify()
+        if not info:
+            raise arbitrage.DeviceException
+        self.gen=gen
+        self.index=RegisterIndex() if index is None else index
+        self.instrument=','.join(f.strip() for f in info.split(',')[:3])
+        self.registers=list(registers)
+        self.hits=0
+        self.misses=0
+
+    def use_waveform(self, shape, normalize=True, **params):
+        """Makes 'shape' the device's arbitrary waveform and returns the register holding it.
+        'shape' and 'params' are as for encode(), 'shape' can also be an encoded DacBlock.
+        A stored waveform is recalled, otherwise it is uploaded, checked with sync() and saved"""
+        gen=self.gen
+        if isinstance(shape, arbitrage.DacBlock):
+            block=shape
+        else:
+            block=encode(shape, gen.awpoints, gen.dacrange, gen.dacbyteorder, normalize, **params)
+        key=hashlib.blake2b(block, digest_size=16).hexdigest()
+        slots=self.index.slots(self.instrument)
+        for reg, stored in slots:
+            if stored == key and reg in self.registers:
+                self.hits+=1
+                gen.recall_state(reg)
+                self.index.assign(self.instrument, reg, key)
+                self.index.save()
+                return reg
+        self.misses+=1
+        used=[reg for reg, stored in slots]
+        free=[reg for reg in self.registers if reg not in used]
+        if free:
+            reg=free[0]
+        else:
+            reg=next(reg for reg, stored in slots if reg in self.registers)
+        # drop the register from the index first, it holds neither waveform if the upload fails
+        self.index.assign(self.instrument, reg)
+        self.index.save()
+        gen.set_aw_dac(block)
+        gen.save_state(reg)
+        gen.recall_state(reg)
+        gen.sync()
+        self.index.assign(self.instrument, reg, key)
+        self.index.save()
+        return reg
+
+    def stored(self):
+        """Returns a dict register -> content hash of the waveforms known to be on the device"""
+        return {reg: key for reg, key in self.index.slots(self.instrument) if reg in self.registers}